@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Alternating Variable Method
+#
+# For targets taking a few numbers (or characters), hill climbing on the
+# values is much faster than evolving derivation trees. The input is a
+# vector of int, float and character variables. One variable at a time is
+# moved by the smallest step either way; if that improves the fitness of
+# the target branch, the move is repeated with steps doubling each time
+# (a pattern move) until it overshoots, and the search explores again from
+# there. When no variable can be improved, the search restarts from random
+# values. Inputs are ranked by the branches they miss on the path to the
+# target branch, then by their fitness on that path. Characters compare by
+# their codes (dexpr.CodePointDistInterpreter), so that the distance of a
+# character tells which way to move it.
+# A branch deep in the CFG is reached by chaining: the branches on its path
+# are covered in turn, each search starting from the input of the one
+# before.
+
+import io
+import random
+import contextlib
+import branchcov
+import branchfitness
+import dexpr
+import evolvefuzz
+import mosa
+
+# How many executions to spend on a branch
+MAX_EVALUATIONS = 1000
+
+# How many trace events an execution may take
+MAX_LINES = 10000
+
+# The decimal places of float variables
+FLOAT_PRECISION = 2
+
+# The values of random restarts, and the codes of character variables
+INT_RANGE = (-100, 100)
+CHAR_RANGE = (32, 126)
+
+def flatten(values):
+    """
+    The kinds ('int', 'float' or 'char') and values of the variables of an
+    input; a string is a variable for each of its characters.
+    """
+    kinds, vector = [], []
+    for v in values:
+        if isinstance(v, str):
+            kinds.extend('char' for c in v)
+            vector.extend(ord(c) for c in v)
+        else:
+            kinds.append('float' if isinstance(v, float) else 'int')
+            vector.append(v)
+    return kinds, vector
+
+def unflatten(template, vector):
+    # the values of the vector, shaped like the template
+    values, k = [], 0
+    for v in template:
+        if isinstance(v, str):
+            values.append(''.join(chr(c) for c in vector[k:k + len(v)]))
+            k += len(v)
+        else:
+            values.append(vector[k])
+            k += 1
+    return values
+
+def encode(values):
+    # the input for main(arg) of gcd and triangle
+    return ' '.join(str(v) for v in values)
+
+class AVM:
+    def __init__(self, template, target=None, encode=encode, functions=None,
+                 precision=FLOAT_PRECISION, max_lines=MAX_LINES, rng=random):
+        self.target = target if target is not None else evolvefuzz.target
+        self.analysis = self.target.analysis
+        self.template = list(template)
+        self.kinds, self.start = flatten(self.template)
+        self.encode = encode
+        self.precision = precision
+        self.max_lines = max_lines
+        self.rng = rng
+        if functions is None:
+            functions = {n['function'] for n in self.analysis.cfg.values() if n.get('function')}
+        self.targets = mosa.branches(self.analysis, functions)
+        self.paths = {t:self.analysis.edge_path(*t) for t in self.targets}
+        # branch -> the branches on its path, including itself
+        self.goals = {t:[(b, a) for (b, a) in zip(p, p[1:]) if (b, a) in self.paths]
+                      for t, p in self.paths.items()}
+        # input -> (arcs, distance table); the coverage itself is not kept
+        self.executions = {}
+        # branch -> the first values covering it
+        self.archive = {}
+        self.evaluations = 0
+
+    def values(self, vector):
+        return unflatten(self.template, vector)
+
+    def execute(self, vector):
+        term = self.encode(self.values(vector))
+        if term not in self.executions:
+            self.evaluations += 1
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    coverage = self.target.execute(term, self.max_lines)
+            except (Exception, branchcov.LineBudgetExceeded):
+                # the coverage up to the exception (or the line budget)
+                coverage = branchcov.coverage_record(branchcov.traceit.cov_arcs)
+            arcs = {(i,j) for f,i,j,src,l in coverage[0]}
+            for t in self.targets:
+                if t in arcs and t not in self.archive:
+                    self.archive[t] = self.values(vector)
+            distances = branchfitness.distance_table(self.analysis, coverage,
+                                                     dexpr.CodePointDistInterpreter)
+            self.executions[term] = (arcs, distances)
+        return self.executions[term]
+
+    def objective(self, vector, branch, path):
+        """
+        The number of branches on the path to the branch that the input
+        misses, then its fitness; lower is better, and (0, 0.0) is covered.
+        The approach level of the fitness is that of the path, whatever
+        the execution; counting the missed branches keeps the search from
+        trading a branch it already takes for a smaller distance elsewhere.
+        """
+        arcs, distances = self.execute(vector)
+        missed = sum(1 for goal in self.goals[branch] if goal not in arcs)
+        if not missed: return (0, 0.0)
+        return (missed, branchfitness.table_fitness(self.analysis, distances, path))
+
+    def move(self, vector, i, step):
+        # the vector with variable i moved by step units
+        moved = list(vector)
+        kind = self.kinds[i]
+        if kind == 'float':
+            moved[i] = round(vector[i] + step * 10 ** -self.precision, self.precision)
+        elif kind == 'char':
+            moved[i] = min(max(vector[i] + step, CHAR_RANGE[0]), CHAR_RANGE[1])
+        else:
+            moved[i] = vector[i] + step
+        return moved
+
+    def climb(self, vector, i, branch, path, best, limit):
+        """
+        Exploratory and pattern moves on variable i, as long as they
+        improve. Returns the best vector and its objective.
+        """
+        improved = True
+        while improved and best[0] and self.evaluations < limit:
+            improved = False
+            for direction in (-1, 1):
+                candidate = self.move(vector, i, direction)
+                value = self.objective(candidate, branch, path)
+                if value >= best: continue
+                vector, best, improved = candidate, value, True
+                # pattern moves: double the step until it stops improving
+                step = 2 * direction
+                while best[0] and self.evaluations < limit:
+                    candidate = self.move(vector, i, step)
+                    value = self.objective(candidate, branch, path)
+                    if value >= best: break
+                    vector, best = candidate, value
+                    step *= 2
+                break
+        return vector, best
+
+    def random_vector(self):
+        vector = []
+        for kind in self.kinds:
+            if kind == 'char': vector.append(self.rng.randint(*CHAR_RANGE))
+            elif kind == 'float':
+                vector.append(round(self.rng.uniform(*INT_RANGE), self.precision))
+            else: vector.append(self.rng.randint(*INT_RANGE))
+        return vector
+
+    def search(self, branch, start=None, budget=MAX_EVALUATIONS):
+        """
+        Values covering the branch, found by the alternating variable
+        method from start, or None after budget executions.
+        """
+        path = self.paths[branch]
+        limit = self.evaluations + budget
+        vector = list(start if start is not None else self.start)
+        best = self.objective(vector, branch, path)
+        while best[0] and self.evaluations < limit:
+            before = best
+            for i in range(len(vector)):
+                vector, best = self.climb(vector, i, branch, path, best, limit)
+                if not best[0]: break
+            if best[0] and best == before:
+                # a local optimum: start over
+                vector = self.random_vector()
+                best = self.objective(vector, branch, path)
+        return vector if not best[0] else None
+
+    def cover(self, branch, budget=MAX_EVALUATIONS):
+        """
+        Values covering the branch, reached by covering the branches on
+        its path in turn, or None.
+        """
+        vector = self.start
+        limit = self.evaluations + budget
+        for goal in self.goals[branch]:
+            if goal in self.archive:
+                vector = flatten(self.archive[goal])[1]
+                continue
+            vector = self.search(goal, vector, limit - self.evaluations)
+            if vector is None: return None
+        return self.values(vector)
+
+    def cover_all(self, budget=MAX_EVALUATIONS):
+        # try each uncovered branch, nearest the entry first; returns the archive
+        for t in sorted(self.targets, key=lambda t: len(self.paths[t])):
+            if t not in self.archive: self.cover(t, budget)
+        return self.archive
+
+    def uncovered(self):
+        return [t for t in self.targets if t not in self.archive]
+
+if __name__ == "__main__":
+    import sys
+    module = sys.argv[1] if len(sys.argv) > 1 else 'triangle'
+    template = [int(v) for v in sys.argv[2:]] or [0, 0, 0]
+    avm = AVM(template, evolvefuzz.Target(module, 'main'))
+    archive = avm.cover_all()
+    print("Executions: %d" % avm.evaluations)
+    for t in sorted(archive):
+        print("%s\t%s" % (repr(t), encode(archive[t])))
+    print("Uncovered: %s" % repr(avm.uncovered()))
@@ -8,8 +8,19 @@ Control_Flow_Re = [re.compile(r'^ *%s +(.+) *: *' % i) for i in Control_Flow]
 # else, continue, break, and pass do not have conditionals
 # that can be evaluated.
 
+# Not an Exception, so that a target catching all exceptions can not carry
+# on once its budget is spent
+class LineBudgetExceeded(BaseException):
+    pass
+
 def traceit(frame, event, arg):
     if event in ['call', 'return', 'line']:
+        if traceit.budget is not None:
+            # once spent, the budget stays spent: every later event raises
+            # again, until capture_coverage returns
+            traceit.budget -= 1
+            if traceit.budget < 0:
+                raise LineBudgetExceeded()
         fname, line = frame.f_code.co_filename, frame.f_lineno
         myvars = {**frame.f_globals, **frame.f_locals} # should we do deep copy?
         finfo = inspect.getframeinfo(frame)
@@ -22,21 +33,33 @@ def traceit(frame, event, arg):
     else: pass # 'exception'
     return traceit
 
-def capture_coverage(fn):
+traceit.budget = None
+
+# Run fn under the tracer. If max_lines is given, fn is stopped with
+# LineBudgetExceeded after that many trace events. If fn raises, the
+# coverage so far is left in traceit.cov_arcs.
+def capture_coverage(fn, max_lines=None):
     traceit.cov_arcs = []
     traceit.prevline = 0
+    traceit.budget = max_lines
     oldtrace = sys.gettrace()
     sys.settrace(traceit)
-    fn()
-    sys.settrace(oldtrace)
+    try:
+        fn()
+    finally:
+        sys.settrace(oldtrace)
+        traceit.budget = None
+    return coverage_record(traceit.cov_arcs)
+
+def coverage_record(cov_arcs):
     branch_cov = {}
     source_code = {}
 
-    for f,i,j,conditional,l in traceit.cov_arcs:
+    for f,i,j,conditional,l in cov_arcs:
         branch_cov.setdefault(i, set()).add(j)
         source_code[j] = (f, conditional, l)
 
-    return (traceit.cov_arcs, source_code, branch_cov)
+    return (cov_arcs, source_code, branch_cov)
 
 if __name__ == '__main__':
     import json
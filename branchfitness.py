@@ -4,102 +4,255 @@ import pycfg
 import math
 import dexpr
 import branchcov
+import collections
 from importlib.machinery import SourceFileLoader
 
+def normalized(x): return x / (x + 1.0)
+
+# The distance of a predicate that can not be evaluated: farther than any
+# distance we compute, but finite, so that it does not count as 0
+UNKNOWN_DISTANCE = 10 ** 9
+
+class Analysis(collections.namedtuple('Analysis',
+    'cfg dom postdom path_tree successors control_deps predicates edges '
+    'edge_paths approach_levels')):
+    """
+    The precomputed, immutable analysis of a module. It holds everything
+    that does not depend on a particular execution, so that one analysis
+    can be shared by any number of threads, processes (it pickles) and
+    batch callers. The per execution functions below take the analysis,
+    the coverage record of an execution (as returned by
+    branchcov.capture_coverage) and the target, and keep no state.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_file(cls, pythonfile):
+        cfg, first, last = pycfg.get_cfg(pythonfile)
+        cfg = dict(cfg)
+        dom = pycfg.compute_dominator(cfg, start=first, key='parents')
+        postdom = pycfg.compute_dominator(cfg, start=last, key='children')
+        lines = pycfg.slurp(pythonfile).strip().split('\n')
+        return cls.from_flow(cfg, dom, postdom, start=first, lines=lines)
+
+    @classmethod
+    def from_flow(cls, cfg, dom, postdom, start=0, lines=None):
+        # The 'children' of the cfg do not include the return sites of the
+        # function calls, while the 'parents' do. Hence we invert the parents.
+        successors = {n:set() for n in cfg}
+        for n in cfg:
+            for p in cfg[n]['parents']:
+                successors.setdefault(p, set()).add(n)
+
+        # a is control dependent on b if b has at least two successors, b
+        # dominates a, a does not post dominate b, and a post dominates
+        # one of the successors of b.
+        control_deps = set()
+        for b in cfg:
+            if len(cfg[b]['children']) < 2: continue
+            for s in cfg[b]['children']:
+                control_deps.update((a, b) for a in postdom[s]
+                        if a in dom and b in dom[a] and a not in postdom[b])
+
+        # The conditionals are parsed and translated only once.
+        predicates = {}
+        for n in cfg:
+            if not lines or not (0 < n <= len(lines)): continue
+            matches = (ctrl.match(lines[n-1]) for ctrl in branchcov.Control_Flow_Re)
+            conditional = next((m.group(1) for m in matches if m), None)
+            if conditional is None: continue
+            # conditionals spanning lines do not parse, and the distance
+            # interpreter does not know every kind of expression
+            try:
+                predicates[n] = dexpr.compile_predicate(conditional)
+            except (SyntaxError, NotImplementedError):
+                pass
+
+        edges = tuple((p, l) for l in cfg for p in cfg[l]['parents'])
+        # The path to each edge, and its approach level, do not depend on
+        # the execution either.
+        path_tree = pycfg.compute_path_tree(cfg, start=start)
+        edge_paths = {(p, l):tuple(pycfg.get_path(path_tree, p)) + (l,) for (p, l) in edges}
+        approach_levels = {e:sum(1 for b, a in zip(path, path[1:]) if (a, b) in control_deps)
+                           for e, path in edge_paths.items()}
+        return cls(cfg, dom, postdom, path_tree,
+                {n:frozenset(s) for n, s in successors.items()},
+                frozenset(control_deps), predicates, edges, edge_paths, approach_levels)
+
+    def a_control_dependent_on_b(self, a, b):
+        return (a, b) in self.control_deps
+
+    def edge_path(self, parent, target):
+        # the shortest path from the entry through parent to target
+        path = self.edge_paths.get((parent, target))
+        if path is not None: return list(path)
+        return pycfg.get_path(self.path_tree, parent) + [target]
+
+def approach_level(analysis, path):
+    # path goes from the entry to the target
+    return sum(1 for b, a in zip(path, path[1:]) if (a, b) in analysis.control_deps)
+
+def predicate_cost(analysis, coverage, parent, interpreter=dexpr.DistInterpreter):
+    cov_arcs, source_code, branch_cov = coverage
+    f,src,l = source_code.get(parent, (None, None, None))
+    # no conditional was recorded for the parent (e.g. the entry
+    # node or a call site). We can not tell how close we came.
+    if src is None: return math.inf
+    # Neither can we if the predicate can not be evaluated: the distance
+    # interpreter does not know every kind of expression, and the target of
+    # a for loop is not bound on its first iteration.
+    try:
+        predicate = analysis.predicates.get(parent)
+        if predicate is None: predicate = dexpr.compile_predicate(src)
+        return dexpr.eval_predicate(predicate, l, interpreter)
+    except (SyntaxError, NotImplementedError, NameError):
+        return UNKNOWN_DISTANCE
+    except Exception:
+        # the target itself raised evaluating the predicate, and stopped
+        # there; anywhere else, the error is a bug of the interpreter
+        if cov_arcs and cov_arcs[-1][2] == parent: return UNKNOWN_DISTANCE
+        raise
+
+def distance_table(analysis, coverage, interpreter=dexpr.DistInterpreter):
+    """
+    The branch distance of every node for one execution.
+    The distance of a node is the minimum edge cost over all executed
+    nodes that reach it through unexecuted nodes only. We compute it
+    for all nodes at once with a multi source shortest path search,
+    where executed parents are the sources, and unexecuted nodes
+    propagate the distance they were reached with to their children.
+    The predicates are evaluated by interpreter, a DistInterpreter class.
+    """
+    cov_arcs, source_code, executed = coverage
+    predicate_costs = {}
+    def edge_cost(parent, target):
+        # the parent was executed. Hence, if the target is executed
+        # then there is no cost. Otherwise, the flow diverged here.
+        if target in executed[parent]: return 0
+        # the predicate cost depends only on the values seen at parent, so it
+        # is evaluated at most once per execution.
+        if parent not in predicate_costs:
+            predicate_costs[parent] = predicate_cost(analysis, coverage, parent, interpreter)
+        return predicate_costs[parent]
+
+    cfg = analysis.cfg
+    local = {}
+    for n in cfg:
+        costs = [edge_cost(p, n) for p in cfg[n]['parents'] if p in executed]
+        if costs: local[n] = min(costs)
+
+    distances = {}
+    # Zero weight propagation: the first time a node is reached is
+    # also the minimum, so each node is settled exactly once.
+    for n, cost in sorted(local.items(), key=lambda i: i[1]):
+        if n in distances: continue
+        distances[n] = cost
+        todo = [n]
+        while todo:
+            m = todo.pop()
+            # only unexecuted nodes let us go further down the chain
+            if m in executed: continue
+            for c in analysis.successors[m]:
+                if c not in distances:
+                    distances[c] = cost
+                    todo.append(c)
+    return distances
+
+def _target_distance(distances, target):
+    v = distances.get(target, math.inf)
+    return 0 if v == math.inf else v
+
+def _fitness(al, distances, target):
+    bd = _target_distance(distances, target)
+    if bd == math.inf: return al
+    return (al + normalized(bd))
+
+def table_fitness(analysis, distances, path):
+    # the fitness of path against the distance table of an execution
+    return _fitness(approach_level(analysis, path), distances, path[-1])
+
+def edge_fitness(analysis, distances, edge):
+    # the fitness of the path to the edge, with its precomputed approach level
+    return _fitness(analysis.approach_levels[edge], distances, edge[1])
+
+def branch_distance(analysis, coverage, target):
+    return _target_distance(distance_table(analysis, coverage), target)
+
+def fitness(analysis, coverage, path):
+    return table_fitness(analysis, distance_table(analysis, coverage), path)
+
+def fitness_vector(analysis, coverage, paths):
+    """
+    The fitness of each path (ending in its target) for one execution.
+    The branch distances of all targets come from the same distance table,
+    and the predicates are evaluated once, so the cost is bounded by the
+    size of the CFG rather than by the number of targets times the path
+    length.
+    """
+    distances = distance_table(analysis, coverage)
+    return [table_fitness(analysis, distances, path) for path in paths]
+
+def edge_fitness_vector(analysis, coverage, edges):
+    # fitness_vector for the paths to the edges of the CFG
+    distances = distance_table(analysis, coverage)
+    return [edge_fitness(analysis, distances, edge) for edge in edges]
+
 class Fitness:
+    """
+    Stateful wrapper around an Analysis, for inspecting one execution
+    at a time.
+    """
     def __init__(self, cfg, dom, postdom):
+        self.analysis = Analysis.from_flow(cfg, dom, postdom)
         self.cfg = cfg
         self.dom = dom
         self.postdom = postdom
 
     def init_cfg(self, filename):
-        cfg, founder, last_node = pycfg.get_cfg(filename)
-        self.cfg = dict(cfg)
-        self.dom = pycfg.compute_dominator(self.cfg, start=founder, key='parents')
-        self.postdom = pycfg.compute_dominator(self.cfg, start=last_node, key='children')
+        self.analysis = Analysis.from_file(filename)
+        self.cfg = self.analysis.cfg
+        self.dom = self.analysis.dom
+        self.postdom = self.analysis.postdom
 
     def capture_coverage(self, fn):
-        self.cdata_arcs, self.source_code, self.branch_cov = branchcov.capture_coverage(fn)
+        self.use_coverage(branchcov.capture_coverage(fn))
+
+    def use_coverage(self, coverage):
+        # coverage is the (cov_arcs, source_code, branch_cov) of an execution
+        self.coverage = coverage
+        self.cdata_arcs, self.source_code, self.branch_cov = coverage
+        self._distances = None
+
+    def distance_table(self):
+        if self._distances is None:
+            self._distances = distance_table(self.analysis, self.coverage)
+        return self._distances
 
     def compute_fitness(self, path):
-        def normalized(x): return x / (x + 1.0)
         self.path = path
-        al = self.approach_level()
-        bd = self.branch_distance()
-        if bd == math.inf: return al
-        return (al + normalized(bd))
+        return table_fitness(self.analysis, self.distance_table(), path)
+
+    def compute_fitness_vector(self, paths):
+        distances = self.distance_table()
+        return [table_fitness(self.analysis, distances, path) for path in paths]
+
+    def edge_path(self, parent, target):
+        return self.analysis.edge_path(parent, target)
 
     def print_dom(dom):
         for k in dom: print(k, dom[k])
 
     def approach_level(self):
-        return self._approach_level(reversed(self.path))
+        return approach_level(self.analysis, self.path)
 
     def target(self):
         return self.path[-1]
 
     def branch_distance(self):
-        parents = self.cfg[self.target()]['parents']
-        if parents:
-            v = min(self._branch_distance(p, self.target(), set()) for p in parents)
-            if v == math.inf:
-                return 0
-            else:
-                return v
-        else:
-            return 0
-
-    def compute_predicate_cost(self, parent, target):
-        f,src,l = self.source_code[parent]
-        ei = dexpr.DistInterpreter(l)
-        v = ei.eval(src)
-        return v
-
-    def _branch_distance(self, parent, target, seen):
-        seen = seen | {(parent, target)}
-        parent_dict = self.cfg[parent]
-
-        gparents = [gp for gp in parent_dict['parents'] if (gp, parent) not in seen] # TODO: filter out call sites
-
-        # was the parent executed?
-        if parent in self.branch_cov and not hasattr(self.cfg[parent], 'calls'):
-            # the parent was executed. Hence, if the target is executed
-            # then there is no cost.
-            if target in self.branch_cov[parent]:
-                return 0
-
-            # the target was not executed. Hence the flow diverged here.
-            # print(parent, target)
-            return self.compute_predicate_cost(parent, target)
-
-        else: # The parent was not executed. So go up the chain
-
-            # if we can not go further up, we dont know how close we came
-            if not gparents:
-                return math.inf
-
-            # go up the minimum chain.
-            return min(self._branch_distance(gp, parent, seen) for gp in gparents)
+        return _target_distance(self.distance_table(), self.target())
 
     def a_control_dependent_on_b(self, a, b):
-        # A has at least 2 successors in CFG
-        if len(self.cfg[b]['children']) < 2: return False
-
-        b_successors = self.cfg[b]['children']
-        # B dominates A
-        v1 = b in self.dom[a]
-        # B is not post dominated by A
-        v2 = a not in self.postdom[b]
-        # there exist a successor for B that is post dominated by A
-        v3 = any(a in self.postdom[s] for s in b_successors)
-        return v1 and v2 and v3
-
-    def _approach_level(self, path):
-        if not path: return 0
-        hd, *tl = path
-        if not tl: return 0
-        cost = 1 if self.a_control_dependent_on_b(hd, tl[0]) else 0
-        return cost + self._approach_level(tl)
+        return self.analysis.a_control_dependent_on_b(a, b)
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Fuzzing campaigns
+#
+# A campaign evolves inputs from a grammar against a function of a target
+# module, for a budget of children bred. The target and its analysis are
+# loaded lazily, once per process, so that starting up costs only the
+# imports, and any module and grammar can be fuzzed with the same tool:
+#
+#   campaign.py example cgi_decode -g evolvefuzz:cgi_grammar -b 1000
+#
+# With a checkpoint file, the whole state of the campaign -- population,
+# operators, fitness cache, coverage archive, findings, counters and random
+# state --
+# is saved periodically, and the campaign can be resumed from it, exactly
+# as if it had not been interrupted:
+#
+#   campaign.py example cgi_decode -b 100000 -c run.ckpt
+#   campaign.py -b 100000 -c run.ckpt --resume
+
+import os
+import json
+import zlib
+import pickle
+import random
+import tempfile
+import importlib
+import evolvefuzz
+import mutators
+import steadystate
+from grammarfuzz import all_terminals, compile_grammar
+
+# How many children are bred and evaluated together
+BATCH_SIZE = 10
+
+# Report progress every so many children
+REPORT_INTERVAL = 100
+
+# Save a checkpoint every so many children
+CHECKPOINT_INTERVAL = 1000
+
+# Bump this whenever the checkpoint state changes
+CHECKPOINT_VERSION = 4
+
+def load_grammar(spec):
+    """
+    A grammar from 'module:name' (a dict in a module), or from a JSON file.
+    """
+    if spec.endswith('.json'):
+        with open(spec) as f: return json.load(f)
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+class Campaign:
+    def __init__(self, module, function, grammar, budget=1000, seeds=(),
+                 processes=0, seed=None, report=print, checkpoint=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.target = evolvefuzz.Target(module, function)
+        self.grammar = compile_grammar(grammar)
+        self.budget = budget
+        self.seeds = list(seeds)
+        self.processes = processes
+        self.seed = seed
+        self.report = report
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.engine = None
+        # the global state of a resumed campaign, restored when it runs
+        self.restored = None
+        self.reported = 0
+        self.saved = 0
+
+    def state(self):
+        return {'version': CHECKPOINT_VERSION,
+                'target': self.target,
+                'grammar': self.grammar,
+                'budget': self.budget,
+                'seed': self.seed,
+                'engine': self.engine,
+                'reported': self.reported,
+                'random': random.getstate(),
+                'cache': evolvefuzz.fitness_cache,
+                'archive': evolvefuzz.coverage_archive,
+                'findings': evolvefuzz.findings}
+
+    def save(self, path=None):
+        """
+        Save the state of the campaign, compressed. The file is written
+        next to the checkpoint and renamed, so that a checkpoint is never
+        left half written.
+        """
+        path = path or self.checkpoint
+        data = zlib.compress(pickle.dumps(self.state(), pickle.HIGHEST_PROTOCOL))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.saved = self.engine.children
+
+    @classmethod
+    def resume(cls, path, budget=None, processes=0, report=print,
+               checkpoint_interval=CHECKPOINT_INTERVAL):
+        with open(path, 'rb') as f:
+            state = pickle.loads(zlib.decompress(f.read()))
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('%s: unsupported checkpoint version %r' % (path, state.get('version')))
+        target = state['target']
+        campaign = cls(target.module_name, target.function_name, state['grammar'],
+                       budget or state['budget'], (), processes, state['seed'], report,
+                       path, checkpoint_interval)
+        campaign.target = target
+        campaign.engine = state['engine']
+        campaign.reported = state['reported']
+        campaign.saved = campaign.engine.children
+        campaign.restored = state
+        return campaign
+
+    def progress(self):
+        (tree, fitness) = self.engine.best()
+        cache = evolvefuzz.fitness_cache
+        self.report("%d children, best %s (%r), %d edges covered, %d findings, cache hit rate %.0f%%" %
+                    (self.engine.children, repr(fitness), all_terminals(tree),
+                     len(evolvefuzz.coverage_archive), len(evolvefuzz.findings),
+                     100 * cache.hit_rate()))
+
+    def run(self):
+        """
+        Run the campaign, and return the best (tree, fitness).
+        """
+        evolvefuzz.set_target(self.target)
+        if self.restored is not None:
+            random.setstate(self.restored['random'])
+            evolvefuzz.fitness_cache.update(self.restored['cache'])
+            evolvefuzz.coverage_archive.update(self.restored['archive'])
+            evolvefuzz.findings.update(self.restored['findings'])
+            self.restored = None
+        elif self.seed is not None:
+            random.seed(self.seed)
+        pool = evolvefuzz.fitness_pool(self.processes) if self.processes else None
+        try:
+            if self.engine is None:
+                pop = evolvefuzz.population(self.grammar, self.seeds, pool)
+                self.engine = steadystate.SteadyState(self.grammar, pop,
+                    mutators.Mutator(self.grammar), pool)
+            self.engine.pool = pool
+            while self.engine.children < self.budget:
+                bred = self.engine.children
+                self.engine.step(min(BATCH_SIZE, self.budget - bred))
+                if self.engine.children == bred:
+                    # nothing new can be bred any more
+                    break
+                if self.engine.children - self.reported >= REPORT_INTERVAL:
+                    self.reported = self.engine.children
+                    self.progress()
+                if self.checkpoint and self.engine.children - self.saved >= self.checkpoint_interval:
+                    self.save()
+            if self.checkpoint: self.save()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self.engine.best()
+
+# Run a campaign, and return the best (tree, fitness)
+def run_campaign(module, function, grammar, budget=1000, **options):
+    return Campaign(module, function, grammar, budget, **options).run()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('module', nargs='?', help='the module under test')
+    parser.add_argument('function', nargs='?', help='the function called with each input')
+    parser.add_argument('-g', '--grammar', default='evolvefuzz:cgi_grammar',
+                        help='module:name of a grammar, or a JSON file')
+    parser.add_argument('-b', '--budget', type=int, default=None,
+                        help='children to breed (default 1000, or that of the checkpoint)')
+    parser.add_argument('-i', '--seeds', default=None, help='file of seed inputs, one per line')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='use a process pool')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='the seed')
+    parser.add_argument('-c', '--checkpoint', default=None, help='checkpoint file')
+    parser.add_argument('-r', '--resume', action='store_true', help='resume from the checkpoint')
+    args = parser.parse_args()
+    if args.resume:
+        if not args.checkpoint: parser.error('--resume needs a checkpoint')
+        campaign = Campaign.resume(args.checkpoint, args.budget, args.processes)
+    else:
+        if not args.function: parser.error('the module and function are required')
+        seeds = []
+        if args.seeds:
+            with open(args.seeds) as f: seeds = [line.rstrip('\n') for line in f]
+        campaign = Campaign(args.module, args.function, load_grammar(args.grammar),
+                            args.budget or 1000, seeds, args.processes, args.seed,
+                            checkpoint=args.checkpoint)
+    (tree, fitness) = campaign.run()
+    campaign.progress()
+    evolvefuzz.print_population(campaign.engine.population())
+    for found, term in evolvefuzz.findings.items():
+        print("%s: %r" % (found, term))
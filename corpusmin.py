@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Corpus minimization
+#
+# Run each input of a corpus against the target, and keep a smallest set of
+# inputs covering the same arcs. The arcs of each input are kept as a
+# bitmap (a Python int, one bit per arc seen in the corpus), and the subset
+# is picked by weighted greedy set cover: repeatedly, the input with the
+# most new arcs per unit of cost, where the cost is the length of the input
+# or the time it takes to run. The gains are updated lazily, with a heap.
+# The coverage is collected by a process pool.
+
+import time
+import heapq
+import multiprocessing
+import evolvefuzz
+
+def popcount(x):
+    return bin(x).count('1')
+
+def input_coverage(term):
+    # the arcs of the input in the target, and the time it took; the
+    # coverage up to a crash or a hang counts as well
+    filename = evolvefuzz.target.module.__file__
+    start = time.time()
+    (coverage, found) = evolvefuzz.run(term)
+    elapsed = time.time() - start
+    arcs = {(i, j) for f, i, j, src, l in coverage[0] if f == filename}
+    return (tuple(sorted(arcs)), elapsed)
+
+def collect(terms, processes=0):
+    """
+    The (arcs, seconds) of each input, for the target of evolvefuzz.
+    """
+    if not processes: return [input_coverage(term) for term in terms]
+    with multiprocessing.Pool(processes, initializer=evolvefuzz.init_worker,
+                              initargs=(evolvefuzz.target,)) as pool:
+        chunksize = max(1, len(terms) // (processes * evolvefuzz.CHUNKS_PER_WORKER))
+        return pool.map(input_coverage, terms, chunksize)
+
+def edge_bitmaps(coverages):
+    # number the arcs, and turn the arcs of each input into a bitmap
+    index = {}
+    bitmaps = []
+    for (arcs, elapsed) in coverages:
+        bitmap = 0
+        for arc in arcs:
+            i = index.setdefault(arc, len(index))
+            bitmap |= 1 << i
+        bitmaps.append(bitmap)
+    return index, bitmaps
+
+def greedy_cover(bitmaps, costs):
+    """
+    The indexes of a subset of the bitmaps covering all of their bits,
+    picked by most new bits per cost first.
+    """
+    covered = 0
+    chosen = []
+    # (-gain per cost, index); the gains only decrease, so an entry still
+    # on top after updating its gain is the best choice.
+    heap = [(-popcount(b) / costs[i], i) for i, b in enumerate(bitmaps) if b]
+    heapq.heapify(heap)
+    while heap:
+        (score, i) = heapq.heappop(heap)
+        gain = popcount(bitmaps[i] & ~covered)
+        if not gain: continue
+        score = -gain / costs[i]
+        if heap and score > heap[0][0]:
+            heapq.heappush(heap, (score, i))
+            continue
+        chosen.append(i)
+        covered |= bitmaps[i]
+    return chosen
+
+def minimize(terms, processes=0, weight='length'):
+    """
+    A subset of the inputs covering the same arcs of the target. weight is
+    'length' to prefer short inputs, or 'time' to prefer fast ones.
+    """
+    terms = list(dict.fromkeys(terms))
+    coverages = collect(terms, processes)
+    index, bitmaps = edge_bitmaps(coverages)
+    if weight == 'time':
+        costs = [elapsed + 1e-6 for (arcs, elapsed) in coverages]
+    else:
+        costs = [len(term) + 1 for term in terms]
+    return [terms[i] for i in greedy_cover(bitmaps, costs)]
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('module', help='the module under test')
+    parser.add_argument('function', help='the function called with each input')
+    parser.add_argument('corpus', help='file of inputs, one per line')
+    parser.add_argument('-o', '--output', default=None, help='file for the minimized corpus')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='use a process pool')
+    parser.add_argument('-w', '--weight', choices=['length', 'time'], default='length',
+                        help='prefer short or fast inputs')
+    args = parser.parse_args()
+    evolvefuzz.set_target(evolvefuzz.Target(args.module, args.function))
+    with open(args.corpus) as f: terms = [line.rstrip('\n') for line in f]
+    kept = minimize(terms, args.processes, args.weight)
+    if args.output:
+        with open(args.output, 'w') as out:
+            for term in kept: print(term, file=out)
+    else:
+        for term in kept: print(term)
+    print("kept %d of %d inputs" % (len(kept), len(terms)), file=sys.stderr)
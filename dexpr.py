@@ -27,7 +27,7 @@ def hamming_delta(s1, s2):
 def delta(a, b):
     if type(a) in [int, float] and type(b) in [int, float]: return abs(a - b)
     elif type(a) is str and type(b) is str: return hamming_delta(a, b)
-    else: raise Exception('Incorrect Delta  %s : %s' %(a,b))
+    else: raise NotImplementedError('Incorrect Delta  %s : %s' %(a,b))
 
 class DistInterpreter(interp.ExprInterpreter):
     """
@@ -45,13 +45,13 @@ class DistInterpreter(interp.ExprInterpreter):
         # cmpop = Eq | NotEq | Lt | LtE | Gt | GtE | Is | IsNot | In | NotIn
         self.cmpop = {
 
-          ast.Eq: lambda a, b: 0 if a == b else delta(a, b) + 1,
+          ast.Eq: lambda a, b: 0 if a == b else self.delta(a, b) + 1,
           ast.NotEq: lambda a, b: 0 if a != b else 1,
 
-          ast.Lt: lambda a, b: 0 if a < b else delta(a, b) + 1,
-          ast.LtE: lambda a, b: 0 if a <= b else delta(a, b) + 1,
-          ast.Gt: lambda a, b: 0 if a > b else delta(a, b) + 1,
-          ast.GtE: lambda a, b: 0 if a >= b else delta(a, b) + 1,
+          ast.Lt: lambda a, b: 0 if a < b else self.delta(a, b) + 1,
+          ast.LtE: lambda a, b: 0 if a <= b else self.delta(a, b) + 1,
+          ast.Gt: lambda a, b: 0 if a > b else self.delta(a, b) + 1,
+          ast.GtE: lambda a, b: 0 if a >= b else self.delta(a, b) + 1,
 
           ast.Is: lambda a, b: 0 if a is b else 1,
           ast.IsNot: lambda a, b: 0 if a is not b else 1,
@@ -65,6 +65,9 @@ class DistInterpreter(interp.ExprInterpreter):
           ast.Or: lambda a, b: min(a, b)
         }
 
+    def delta(self, a, b):
+        return delta(a, b)
+
     def on_nameconstant(self, node):
         """
         Boolean true? 0 : 1
@@ -73,6 +76,10 @@ class DistInterpreter(interp.ExprInterpreter):
             return 0 if node.value else 1
         return node.value
 
+    def on_constant(self, node):
+        # True, False and None are constants too from Python 3.8 on
+        return self.on_nameconstant(node)
+
     def on_expr(self, node):
         return self.walk(self.dtrans(node.value))
 
@@ -111,7 +118,7 @@ class DistInterpreter(interp.ExprInterpreter):
             node.op = op
             return node
         else:
-            raise Exception('Not not applicable %s' % astunparse.unparse(node))
+            raise NotImplementedError('Not not applicable %s' % astunparse.unparse(node))
 
     def not_cmp_trans(self, op):
         trans=dict([(ast.Eq,ast.Eq()),(ast.NotEq,ast.NotEq()),(ast.Lt,ast.Lt()),(ast.Gt,ast.Gt()),(ast.LtE,ast.LtE()),(ast.GtE,ast.GtE()),(ast.In,ast.In()),(ast.NotIn,ast.NotIn())])
@@ -127,6 +134,28 @@ class DistInterpreter(interp.ExprInterpreter):
             op = ast.And()
         return (self.not_node(a), op, self.not_node(b))
 
+class CodePointDistInterpreter(DistInterpreter):
+    """
+    The branch distance evaluator for searches on character codes (avm):
+    single characters are as far apart as their codes, so that the search
+    can tell which way to go
+    """
+    def delta(self, a, b):
+        if type(a) is str and type(b) is str and len(a) == len(b) == 1:
+            return abs(ord(a) - ord(b))
+        return delta(a, b)
+
+def compile_predicate(src):
+    """
+    Parse and translate the predicate once. The result can be evaluated
+    any number of times with eval_predicate (the translation rewrites the
+    ast in place, and hence can not be repeated on the same tree).
+    """
+    return DistInterpreter({}).dtrans(ast.parse(src).body[0].value)
+
+def eval_predicate(predicate, symtable, interpreter=DistInterpreter):
+    return interpreter(symtable).walk(predicate)
+
 if __name__ == '__main__':
     expr = DistInterpreter(json.loads(sys.argv[2]))
     v = expr.eval(sys.argv[1])
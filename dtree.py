@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Array backed derivation trees
+#
+# A derivation tree is kept in parallel integer arrays, one entry per node:
+# the interned symbol id, the kind of node, the parent, the first child and
+# the next sibling, and the length of the string the node yields. Subtrees
+# are replaced by appending the new nodes and relinking them, and the yield
+# string of the whole tree is cached and spliced on replacement. Trees
+# convert to and from the (SYMBOL, CHILDREN) tuple format of grammarfuzz.
+
+import array
+import random
+from grammarfuzz import expand_tree
+
+# The kinds of nodes, corresponding to the CHILDREN of the tuple format
+TERMINAL = 0   # []
+EXPANDED = 1   # a list of children
+UNEXPANDED = 2 # None
+
+NONE = -1
+
+class Symbols:
+    """
+    Interned symbols. Symbol ids are stable, so that trees sharing a
+    symbol table can be compared by their symbol arrays.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+# The symbol table shared by default
+SYMBOLS = Symbols()
+
+class ArrayTree:
+    def __init__(self, symbols=SYMBOLS):
+        self.symbols = symbols
+        self.sym = array.array('i')
+        self.kind = array.array('b')
+        self.parent = array.array('i')
+        self.first = array.array('i')
+        self.next = array.array('i')
+        self.length = array.array('q')
+        self.root = NONE
+        self.live = 0
+        self._yield = None
+
+    @classmethod
+    def from_tuple(cls, tree, symbols=SYMBOLS):
+        t = cls(symbols)
+        t.root = t._build(tree, NONE)
+        return t
+
+    def copy(self):
+        t = ArrayTree(self.symbols)
+        t.sym, t.kind, t.parent = self.sym[:], self.kind[:], self.parent[:]
+        t.first, t.next, t.length = self.first[:], self.next[:], self.length[:]
+        t.root, t.live, t._yield = self.root, self.live, self._yield
+        return t
+
+    def _node(self, name, kind, parent):
+        self.sym.append(self.symbols.intern(name))
+        self.kind.append(kind)
+        self.parent.append(parent)
+        self.first.append(NONE)
+        self.next.append(NONE)
+        self.length.append(len(name) if kind != EXPANDED else 0)
+        return len(self.sym) - 1
+
+    def _build(self, tree, parent):
+        # Append the nodes of a tuple tree, and return the id of its root.
+        # Children always get larger ids than their parents, so the
+        # lengths can be summed up in one pass in reverse.
+        base = len(self.sym)
+        (symbol, children) = tree
+        root = self._node(symbol, UNEXPANDED if children is None else
+                          (EXPANDED if children else TERMINAL), parent)
+        stack = [(root, children)]
+        while stack:
+            (nid, children) = stack.pop()
+            if not children: continue
+            prev = NONE
+            for (symbol, grandchildren) in children:
+                kind = (UNEXPANDED if grandchildren is None else
+                        (EXPANDED if grandchildren else TERMINAL))
+                c = self._node(symbol, kind, nid)
+                if prev == NONE: self.first[nid] = c
+                else: self.next[prev] = c
+                prev = c
+                stack.append((c, grandchildren))
+        for i in range(len(self.sym) - 1, base, -1):
+            self.length[self.parent[i]] += self.length[i]
+        self.live += len(self.sym) - base
+        return root
+
+    def symbol(self, node):
+        return self.symbols.names[self.sym[node]]
+
+    def children(self, node):
+        c = self.first[node]
+        while c != NONE:
+            yield c
+            c = self.next[c]
+
+    def nodes(self, node=None):
+        # The nodes of the (sub)tree in preorder
+        stack = [self.root if node is None else node]
+        while stack:
+            n = stack.pop()
+            yield n
+            stack.extend(reversed(list(self.children(n))))
+
+    def __len__(self):
+        return self.live
+
+    def start(self, node):
+        # The offset of the yield of node in the yield of the tree
+        s = 0
+        while node != self.root:
+            p = self.parent[node]
+            c = self.first[p]
+            while c != node:
+                s += self.length[c]
+                c = self.next[c]
+            node = p
+        return s
+
+    def string(self, node=None):
+        """
+        The yield of the (sub)tree. The yield of the whole tree is cached,
+        and updated in place when subtrees are replaced.
+        """
+        if node is None and self._yield is not None: return self._yield
+        names = self.symbols.names
+        s = ''.join(names[self.sym[n]] for n in self.nodes(node)
+                    if self.kind[n] != EXPANDED)
+        if node is None: self._yield = s
+        return s
+
+    def replace(self, node, tree):
+        """
+        Replace the subtree at node by tree (a tuple tree), and return the
+        id of the new subtree. Only the ancestors of node are touched.
+        """
+        p = self.parent[node]
+        new = self._build(tree, p)
+        self.next[new] = self.next[node]
+        if p == NONE:
+            self.root = new
+        elif self.first[p] == node:
+            self.first[p] = new
+        else:
+            c = self.first[p]
+            while self.next[c] != node: c = self.next[c]
+            self.next[c] = new
+
+        if self._yield is not None:
+            s = self.start(new)
+            self._yield = (self._yield[:s] + self.string(new) +
+                           self._yield[s + self.length[node]:])
+        delta = self.length[new] - self.length[node]
+        a = p
+        while a != NONE:
+            self.length[a] += delta
+            a = self.parent[a]
+
+        self.live -= sum(1 for n in self.nodes(node))
+        self.parent[node] = NONE
+        # drop the replaced nodes once they take up most of the arrays
+        if self.live * 2 < len(self.sym):
+            new = self.compact(new)
+        return new
+
+    def compact(self, keep=NONE):
+        """
+        Drop the nodes no longer in the tree. Returns the new id of keep.
+        """
+        t = ArrayTree(self.symbols)
+        ids = {}
+        last = {}
+        for n in self.nodes():
+            p = NONE if n == self.root else ids[self.parent[n]]
+            c = len(t.sym)
+            t.sym.append(self.sym[n])
+            t.kind.append(self.kind[n])
+            t.parent.append(p)
+            t.first.append(NONE)
+            t.next.append(NONE)
+            t.length.append(self.length[n])
+            if p != NONE:
+                if p in last: t.next[last[p]] = c
+                else: t.first[p] = c
+                last[p] = c
+            ids[n] = c
+        self.sym, self.kind, self.parent = t.sym, t.kind, t.parent
+        self.first, self.next, self.length = t.first, t.next, t.length
+        self.root = ids[self.root]
+        self.live = len(self.sym)
+        return ids.get(keep, NONE)
+
+    def to_tuple(self, node=None):
+        node = self.root if node is None else node
+        order = list(self.nodes(node))
+        names = self.symbols.names
+        built = {}
+        for n in reversed(order):
+            kind = self.kind[n]
+            if kind == TERMINAL: children = []
+            elif kind == UNEXPANDED: children = None
+            else: children = [built.pop(c) for c in self.children(n)]
+            built[n] = (names[self.sym[n]], children)
+        return built[node]
+
+# Regenerate a random nonterminal subtree of a copy of the tree
+def mutate(tree, grammar, max_symbols = 10):
+    new_tree = tree.copy()
+    candidates = [n for n in new_tree.nodes() if new_tree.kind[n] != TERMINAL]
+    node = random.choice(candidates)
+    subtree = expand_tree((new_tree.symbol(node), None), grammar, max_symbols)
+    new_tree.replace(node, subtree)
+    return new_tree
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# Parse strings into derivation trees
+#
+# An Earley parser for the grammars of grammarfuzz, so that existing inputs
+# can be turned into (SYMBOL, CHILDREN) trees and mutated. Terminals may be
+# longer than one character; they are matched as a whole. The parse keeps a
+# packed forest: for each (nonterminal, start, end) span, the rules that
+# derive it. A tree is then extracted from the forest without recursion,
+# sharing the subtree of each span, so that long inputs of left or right
+# recursive grammars parse without running into the recursion limit.
+# Left recursion parses in linear time; long right recursive chains (e.g.
+# $ITEMS -> $AN_ITEM$ITEMS) take quadratic time, as there are no Leo items.
+
+import sys
+from grammarfuzz import compile_grammar
+
+class Forest:
+    """
+    The packed parse forest of a string. alternatives[(nt, i, j)] are the
+    rules of nt that derive text[i:j].
+    """
+    def __init__(self, parser, text, charts, alternatives, starts):
+        self.parser = parser
+        self.text = text
+        self.charts = charts
+        self.alternatives = alternatives
+        self.starts = starts
+
+    def _derivation(self, key, path):
+        # A rule of key and the spans of its symbols, such that no
+        # nonterminal span is one of the (unfinished) ancestors in path.
+        # We walk each rule backwards through the chart: the item with the
+        # dot before symbol k is in the chart where symbol k starts.
+        (nt, i, j) = key
+        parser = self.parser
+        for r in self.alternatives[key]:
+            rid = parser.base[nt] + r
+            rule = parser.rules[rid]
+            spec = []
+            q = j
+            for k in range(len(rule) - 1, -1, -1):
+                (s, is_nt) = rule[k]
+                item = (rid, k, i)
+                if not is_nt:
+                    p = q - len(s)
+                    spec.append(s)
+                else:
+                    for p in self.starts[(s, q)]:
+                        if item in self.charts[p] and (s, p, q) not in path: break
+                    else:
+                        break
+                    spec.append((s, p, q))
+                q = p
+            else:
+                spec.reverse()
+                return spec
+        raise ValueError('no acyclic derivation of %s at %d:%d' % key)
+
+    def tree(self):
+        """
+        A derivation tree of the whole string.
+        """
+        root = (self.parser.start_symbol, 0, len(self.text))
+        memo = {}
+        specs = {}
+        # the keys with a spec but no tree yet are the ancestors of the top
+        path = set()
+        stack = [root]
+        while stack:
+            key = stack[-1]
+            if key in memo:
+                stack.pop()
+                continue
+            spec = specs.get(key)
+            if spec is None:
+                spec = specs[key] = self._derivation(key, path)
+                path.add(key)
+                stack.extend(c for c in reversed(spec)
+                             if isinstance(c, tuple) and c not in memo)
+                continue
+            # an empty expansion gets an empty terminal, as a nonterminal
+            # without children would read as a terminal
+            memo[key] = (key[0], [memo[c] if isinstance(c, tuple) else (c, [])
+                                  for c in spec] or [('', [])])
+            path.discard(key)
+            stack.pop()
+        return memo[root]
+
+class EarleyParser:
+    def __init__(self, grammar, start_symbol = "$START"):
+        self.start_symbol = start_symbol
+        compiled = compile_grammar(grammar)
+        # Rules are numbered; base[nt] is the number of the first rule of nt
+        self.base = {}
+        self.rules = []
+        self.lhs = []
+        for nt, rules in compiled.rules.items():
+            self.base[nt] = len(self.rules)
+            self.rules.extend(rules)
+            self.lhs.extend(nt for rule in rules)
+        self.predictions = {nt:range(self.base[nt], self.base[nt] + len(rules))
+                            for nt, rules in compiled.rules.items()}
+
+        # The nonterminals deriving the empty string
+        self.nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for rid, rule in enumerate(self.rules):
+                nt = self.lhs[rid]
+                if nt not in self.nullable and all(s in self.nullable for s, is_nt in rule):
+                    self.nullable.add(nt)
+                    changed = True
+
+    def parse_forest(self, text):
+        """
+        The packed forest of text. Raises ValueError if text is not in
+        the language of the grammar.
+        """
+        n = len(text)
+        rules, lhs, predictions, nullable = self.rules, self.lhs, self.predictions, self.nullable
+        charts = [set() for i in range(n + 1)]
+        pending = [[] for i in range(n + 1)]
+        waiting = [None] * (n + 1)
+        alternatives = {}
+        starts = {}
+
+        for rid in predictions[self.start_symbol]:
+            charts[0].add((rid, 0, 0))
+            pending[0].append((rid, 0, 0))
+
+        last = 0
+        for j in range(n + 1):
+            items, seen = pending[j], charts[j]
+            if not items: continue
+            last = j
+            waits = waiting[j] = {}
+            k = 0
+            while k < len(items):
+                item = items[k]
+                k += 1
+                (rid, dot, origin) = item
+                rule = rules[rid]
+                if dot < len(rule):
+                    (s, is_nt) = rule[dot]
+                    if not is_nt:
+                        if text.startswith(s, j):
+                            e = j + len(s)
+                            new = (rid, dot + 1, origin)
+                            if new not in charts[e]:
+                                charts[e].add(new)
+                                pending[e].append(new)
+                        continue
+                    w = waits.get(s)
+                    if w is None:
+                        waits[s] = [item]
+                        for r in predictions[s]:
+                            new = (r, 0, j)
+                            if new not in seen:
+                                seen.add(new)
+                                items.append(new)
+                    else:
+                        w.append(item)
+                    # a nullable nonterminal may be skipped right away, as
+                    # its completion at j may already have happened
+                    if s in nullable:
+                        new = (rid, dot + 1, origin)
+                        if new not in seen:
+                            seen.add(new)
+                            items.append(new)
+                    continue
+
+                # complete
+                nt = lhs[rid]
+                key = (nt, origin, j)
+                alts = alternatives.get(key)
+                if alts is None:
+                    alternatives[key] = [rid - self.base[nt]]
+                    starts.setdefault((nt, j), []).append(origin)
+                else:
+                    alts.append(rid - self.base[nt])
+                for (wrid, wdot, worigin) in waiting[origin].get(nt, ()):
+                    new = (wrid, wdot + 1, worigin)
+                    if new not in seen:
+                        seen.add(new)
+                        items.append(new)
+            pending[j] = None
+
+        if (self.start_symbol, 0, n) not in alternatives:
+            raise ValueError('parse error at position %d' % last)
+        return Forest(self, text, charts, alternatives, starts)
+
+    def parse(self, text):
+        """
+        A derivation tree of text, as used by grammarfuzz.
+        """
+        return self.parse_forest(text).tree()
+
+    def recognize(self, text):
+        try:
+            self.parse_forest(text)
+        except ValueError:
+            return False
+        return True
+
+# Parse a corpus of inputs, dropping duplicates. Inputs not in the language
+# of the grammar are skipped, unless strict is set.
+def parse_corpus(grammar, inputs, strict = False, start_symbol = "$START"):
+    parser = EarleyParser(grammar, start_symbol)
+    seen = set()
+    for text in inputs:
+        if text in seen: continue
+        seen.add(text)
+        try:
+            yield parser.parse(text)
+        except ValueError:
+            if strict: raise
+
+if __name__ == "__main__":
+    import time
+    import grammarfuzz
+    from grammarfuzz import all_terminals
+    grammar = compile_grammar(grammarfuzz.term_grammar)
+    parser = EarleyParser(grammar)
+    inputs = sys.argv[1:] or [grammarfuzz.produce(grammar) for i in range(1, 20)]
+    for text in inputs:
+        start = time.time()
+        tree = parser.parse(text)
+        assert all_terminals(tree) == text
+        print("%.4fs\t%s" % (time.time() - start, text))
@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 # Coverage-Guided Fuzzing
 
-from grammarfuzz import expand_tree, init_tree, all_terminals
+from grammarfuzz import expand_tree, init_tree, all_terminals, CompiledGrammar
 
+import os
 import random
 import sys
-import pycfg
+import hashlib
+import importlib
+import traceback
+import collections
+import multiprocessing
+import branchcov
 import branchfitness
-import math
+import earleyparse
+import mutators
 
 cgi_grammar = {
     "$START": ["$STRING"],
@@ -24,18 +31,6 @@ cgi_grammar = {
 
 ### Our production framework
 
-def all_children_are_terminals(tree):
-    def _all_children_are_terminals(tree):
-        (symbol, children) = tree
-        for c in children:
-            (_, grandchildren) = c
-            if len(grandchildren) > 0:
-                return False
-        return True
-    ret = _all_children_are_terminals(tree)
-    # print("All children of " + repr(tree) + " are terminals: " + repr(ret))
-    return ret
-
 # The likelihood of an individual node to be replaced
 MUTATION_RATIO = 0.1
 
@@ -44,17 +39,15 @@ def mutate(tree, grammar, max_symbols = 10):
     # print("Mutating " + all_terminals(tree) + "...")
     (symbol, children) = tree
 
-    mutate_entire_subtree = (all_children_are_terminals(tree) or
+    # the children we can descend into
+    expanded = [i for i, (_, grandchildren) in enumerate(children) if grandchildren]
+    mutate_entire_subtree = (not expanded or
                              random.random() < MUTATION_RATIO)
 
     if mutate_entire_subtree:
         new_children = None
     else:
-        while True:
-            child_to_be_mutated = int(random.random() * len(children))
-            (_, grandchildren) = children[child_to_be_mutated]
-            if len(grandchildren) != 0:
-                break
+        child_to_be_mutated = random.choice(expanded)
 
         replacement_child = mutate(children[child_to_be_mutated],
                                    grammar, max_symbols)
@@ -73,52 +66,227 @@ def mutate(tree, grammar, max_symbols = 10):
 
 ### Computing the CFG
 
-def find_path(cfg, cov_arcs, parent, seen):
-    if parent == 0:
-        return (1, [parent])
-    ks = []
-    for p in sorted(cfg[parent]['parents']):
-        if p == parent: continue
-        if p in seen: continue
-        k = find_path(cfg, cov_arcs, p, seen | {parent})
-        ks.append(k)
-    val = (math.inf, [])
-    if ks:
-        val = min(ks)
-    return (val[0]+1, val[1] + [parent])
-
-cfg, dom, postdom = pycfg.compute_flow('example.py')
+# Analyses by file and modification time, so that each file is analyzed
+# only once per process
+analyses = {}
+
+def load_analysis(pythonfile):
+    key = (os.path.abspath(pythonfile), os.path.getmtime(pythonfile))
+    if key not in analyses:
+        analyses[key] = branchfitness.Analysis.from_file(pythonfile)
+    return analyses[key]
+
+class Target:
+    """
+    The program under test: the function of the module that is called
+    with each input. The module and its analysis are loaded on first use.
+    """
+    def __init__(self, module = 'example', function = 'cgi_decode'):
+        self.module_name = module
+        self.function_name = function
+        self._module = None
+        self._analysis = None
+
+    def __getstate__(self):
+        # modules do not pickle; the analysis does, and is sent along
+        state = dict(self.__dict__)
+        state['_module'] = None
+        return state
+
+    @property
+    def module(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    @property
+    def function(self):
+        return getattr(self.module, self.function_name)
+
+    @property
+    def analysis(self):
+        if self._analysis is None:
+            self._analysis = load_analysis(self.module.__file__)
+        return self._analysis
+
+    # Run the function with the input, and return its coverage
+    def execute(self, term, max_lines = None):
+        function = self.function
+        return branchcov.capture_coverage(lambda: function(term), max_lines)
+
+# The target of this process
+target = Target()
+
+def set_target(new_target):
+    global target
+    target = new_target
+    # the fitness values and the coverage were those of the old target
+    fitness_cache.clear()
+    coverage_archive.clear()
+    findings.clear()
+
+def __getattr__(name):
+    # evolvefuzz.analysis is that of the target, loaded on first use
+    if name == 'analysis': return target.analysis
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# How many trace events an execution may take before it counts as a hang
+MAX_LINES = 100000
+
+# The first input for each crash (exception and the line raising it) or
+# hang of the target
+findings = {}
+
+def finding(e):
+    if isinstance(e, branchcov.LineBudgetExceeded): return 'hang'
+    frame = traceback.extract_tb(e.__traceback__)[-1]
+    return '%s at %s:%d' % (type(e).__name__, os.path.basename(frame.filename), frame.lineno)
+
+# Run the program under test with the input, and return its coverage and
+# what went wrong, if anything. A crash or a hang does not stop the fuzzer:
+# the coverage up to it counts as that of the input.
+def run(term):
+    try:
+        return target.execute(term, MAX_LINES), None
+    except (Exception, branchcov.LineBudgetExceeded) as e:
+        return branchcov.coverage_record(branchcov.traceit.cov_arcs), finding(e)
+
+# Run the program under test with the input, and return its coverage
+def execute(term):
+    (coverage, found) = run(term)
+    if found is not None: findings.setdefault(found, term)
+    return coverage
+
 # Define the fitness of an individual term - by actually testing it
 def branch_fitness(tree):
-    import example
-    term = all_terminals(tree)
-    ffn = branchfitness.Fitness(cfg, dom, postdom)
-    ffn.capture_coverage(lambda: example.cgi_decode(term))
-    cov_arcs = {(i,j) for f,i,j,src,l in ffn.cdata_arcs}
-    not_covered = set()
-    covered = set()
+    return evaluate_terms([all_terminals(tree)])[0]
+
+def term_fitness(term):
+    return coverage_fitness(execute(term))
+
+# The fitness of the input, the edges of the target it covers, and its
+# finding, if any; findings in a worker come back with the result
+def term_result(term):
+    (coverage, found) = run(term)
+    cov_arcs = {(i,j) for f,i,j,src,l in coverage[0]}
+    edges = tuple(e for e in target.analysis.edges if e in cov_arcs)
+    return (coverage_fitness(coverage), edges, found)
+
+# The fitness of a coverage record from branchcov.capture_coverage
+def coverage_fitness(coverage):
+    analysis = target.analysis
+    cov_arcs = {(i,j) for f,i,j,src,l in coverage[0]}
     # now identify how bad we were
-    for l in ffn.cfg:
-        for p in ffn.cfg[l]['parents']:
-            if (p, l) not in cov_arcs:
-                not_covered.add((p, l))
-            else:
-                covered.add((p, l))
+    not_covered = [(p, l) for (p, l) in analysis.edges if (p, l) not in cov_arcs]
 
     # path = [33, 34, 35, 47]
     # path = [34, 36, 46, 47]
 
-    s = 0
-    seen = set()
-    #print(covered)
-    #print(not_covered)
-    for p,l in not_covered:
-        (n, path) = find_path(cfg, cov_arcs, p, seen | {p})
-        val = ffn.compute_fitness([l] + path )
-        #print(term, val, [l] + path)
-        s += val
-    #print()
-    return s
+    # all uncovered edges are evaluated against the same execution
+    return sum(branchfitness.edge_fitness_vector(analysis, coverage, not_covered))
+
+# How many fitness results to keep
+FITNESS_CACHE_SIZE = 100000
+
+class FitnessCache:
+    """
+    The (fitness, covered edges) of inputs, evicting the least recently
+    used ones. Many mutants yield a string already seen, and need not be
+    executed again.
+    """
+    def __init__(self, maxsize = FITNESS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, term):
+        # a digest of the input, so that long inputs are not kept
+        return hashlib.blake2b(term.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, term):
+        k = self.key(term)
+        result = self.entries.get(k)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(k)
+        return result
+
+    def put(self, term, result):
+        k = self.key(term)
+        self.entries[k] = result
+        self.entries.move_to_end(k)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def update(self, other):
+        # take over the entries and counters of another cache
+        self.maxsize = other.maxsize
+        self.entries = other.entries
+        self.hits = other.hits
+        self.misses = other.misses
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+fitness_cache = FitnessCache()
+
+# The first input covering each edge of the target
+coverage_archive = {}
+
+# How many chunks each worker of a pool gets per evaluation
+CHUNKS_PER_WORKER = 4
+
+def init_worker(new_target):
+    # Load the program under test once per worker; its analysis comes
+    # along with the target.
+    set_target(new_target)
+    new_target.module
+
+# A process pool to evaluate fitness with. The number of its workers is
+# kept on it, to size the chunks sent to them.
+def fitness_pool(processes = None):
+    target.analysis
+    processes = processes or os.cpu_count() or 1
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(target,))
+    pool.processes = processes
+    return pool
+
+# The fitness of each tree. Inputs are executed only once, and looked up
+# in the cache otherwise. With a pool from fitness_pool, only the terms are
+# sent to the workers, in chunks, and only the fitness values and covered
+# edges come back. The edges go to the coverage archive, and crashes and
+# hangs to the findings.
+def evaluate(trees, pool = None):
+    return evaluate_terms([all_terminals(tree) for tree in trees], pool)
+
+def evaluate_terms(terms, pool = None, cache = fitness_cache):
+    return [fitness for (fitness, edges) in evaluate_results(terms, pool, cache)]
+
+# The (fitness, covered edges) of each input
+def evaluate_results(terms, pool = None, cache = fitness_cache):
+    known = {}
+    for term in terms:
+        if term in known: continue
+        known[term] = cache.get(term)
+    missing = [term for term, result in known.items() if result is None]
+    if pool is None or len(missing) < 2:
+        results = [term_result(term) for term in missing]
+    else:
+        chunksize = max(1, len(missing) // (pool.processes * CHUNKS_PER_WORKER))
+        results = pool.map(term_result, missing, chunksize)
+    for term, (fitness, edges, found) in zip(missing, results):
+        known[term] = (fitness, edges)
+        cache.put(term, known[term])
+        for e in edges: coverage_archive.setdefault(e, term)
+        if found is not None: findings.setdefault(found, term)
+    return [known[term] for term in terms]
 
 
 # Number of elements in our population
@@ -133,13 +301,17 @@ EVOLUTION_CYCLES = 10
 def produce(grammar, max_symbols = 10):
     return expand_tree(init_tree(), grammar, max_symbols)
 
-# Create a random population
-def population(grammar):
-    pop = []
+# Create a population, from the parsed seed inputs first, and then from
+# random trees. Trees yielding the same input are kept only once.
+def population(grammar, seeds = (), pool = None):
+    pop = {}
+    for tree in earleyparse.parse_corpus(grammar, seeds):
+        if len(pop) >= POPULATION_SIZE: break
+        pop.setdefault(all_terminals(tree), tree)
     while len(pop) < POPULATION_SIZE:
         tree = produce(grammar)
-        if tree  not in pop: pop.append(tree)
-    return [(tree, branch_fitness(tree)) for tree in pop]
+        pop.setdefault(all_terminals(tree), tree)
+    return list(zip(pop.values(), evaluate_terms(list(pop), pool)))
 
 
 def by_fitness(individual):
@@ -147,22 +319,51 @@ def by_fitness(individual):
     (tree, fitness) = individual
     return fitness
 
-# Evolve the set
-def evolve(pop, grammar):
+# How many batches of children evolve breeds at most in a generation
+MAX_BREEDING_ROUNDS = 10
+
+# Evolve the set. With a mutators.Mutator, children are bred with its
+# operators (crossover and splicing with the selected individuals, too).
+# Children at least as fit as their parent (lower is fitter) are kept. If
+# too few are after MAX_BREEDING_ROUNDS batches, the fittest of the other
+# children make up the rest, so that a population that can not improve
+# does not breed forever.
+def evolve(pop, grammar, mutator = None, pool = None):
     # Sort population by fitness (lowest first)
     # and select the fittest individuals
     best_pop = sorted(pop, key=by_fitness)[:SELECTION_SIZE]
 
-    # Breed
-    offspring = []
-    while len(offspring) + len(best_pop) < POPULATION_SIZE:
-        (parent, parent_fitness) = random.choice(best_pop)
-        child = mutate(parent, grammar)
-        child_fitness = branch_fitness(child)
+    if mutator is not None:
+        parents = [tree for (tree, fitness) in best_pop]
+        for tree in parents: mutator.add(tree)
 
-        if child_fitness >= parent_fitness:
-            offspring.append((child, child_fitness))
+    # Breed, a batch of children at a time, so that they are evaluated
+    # together
+    offspring = []
+    rejected = []
+    for rounds in range(MAX_BREEDING_ROUNDS):
+        if len(offspring) + len(best_pop) >= POPULATION_SIZE: break
+        needed = POPULATION_SIZE - len(offspring) - len(best_pop)
+        batch = []
+        for i in range(needed):
+            (parent, parent_fitness) = random.choice(best_pop)
+            if mutator is None:
+                batch.append((parent_fitness, None, mutate(parent, grammar)))
+            else:
+                (operator, child) = mutator.mutate(parent, parents)
+                batch.append((parent_fitness, operator, child))
+
+        fitnesses = evaluate([child for (_, _, child) in batch], pool)
+        for ((parent_fitness, operator, child), child_fitness) in zip(batch, fitnesses):
+            if operator is not None:
+                mutator.reward(operator, child_fitness, parent_fitness)
+            if child_fitness <= parent_fitness:
+                offspring.append((child, child_fitness))
+            else:
+                rejected.append((child, child_fitness))
 
+    needed = POPULATION_SIZE - len(offspring) - len(best_pop)
+    if needed > 0: offspring += sorted(rejected, key=by_fitness)[:needed]
     next_pop = best_pop + offspring
     return next_pop
 
@@ -175,25 +376,30 @@ def print_population(pop):
     return pop[0]
 
 if __name__ == "__main__":
-    grammar = cgi_grammar
+    grammar = CompiledGrammar(cgi_grammar)
+    # seed inputs, one per line, from the files given
+    seeds = [line.rstrip('\n') for name in sys.argv[1:] for line in open(name)]
 
     tree = produce(grammar)
     print("Tree: " + all_terminals(tree))
     print("Fitness: " + repr(branch_fitness(tree)))
 
+    mutator = mutators.Mutator(grammar)
     best = []
-    for i in range(1,10):
-        # Create a population
-        print("Population:")
-        pop = population(grammar)
-        print_population(pop)
-        p = pop
-        for i in range(EVOLUTION_CYCLES):
-            # Evolve the population
-            print("Evolved:")
-            pop = evolve(pop, grammar)
-            p = print_population(pop)
-            print()
-        best.append(p)
+    with fitness_pool() as pool:
+        for i in range(1,10):
+            # Create a population
+            print("Population:")
+            pop = population(grammar, seeds, pool)
+            print_population(pop)
+            p = pop
+            for i in range(EVOLUTION_CYCLES):
+                # Evolve the population
+                print("Evolved:")
+                pop = evolve(pop, grammar, mutator, pool)
+                p = print_population(pop)
+                print()
+            best.append(p)
     print_population(best)
-
+    print("Fitness cache: %d hits, %d misses (%.0f%%)" %
+          (fitness_cache.hits, fitness_cache.misses, 100 * fitness_cache.hit_rate()))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Fork server execution harness
+#
+# The target is imported and analyzed once, in this process. Each batch of
+# inputs then runs in a forked child, so that a crash, a hang or a memory
+# blow-up of the target cannot take the campaign down with it. Each input
+# runs under a wall clock timer and a budget of traced lines. The child
+# writes the result of each input -- its status, its fitness, and the
+# covered edges as a bitmap -- into a shared memory map, so nothing needs
+# to be pickled. If the child dies on an input, the parent records it and
+# forks a new child for the rest of the batch. Crashes and hangs are kept
+# as findings; errors of the harness itself (e.g. in the fitness function)
+# are kept apart, as they say nothing about the target.
+
+import os
+import sys
+import mmap
+import struct
+import signal
+import collections
+import branchcov
+
+# The states of a slot
+PENDING = 0
+RUNNING = 1
+OK = 2
+CRASH = 3
+HANG = 4
+ERROR = 5
+
+STATUS_NAMES = {OK: 'ok', CRASH: 'crash', HANG: 'hang', ERROR: 'error'}
+
+# How many inputs a child runs at most
+BATCH_SIZE = 64
+
+# Wall clock seconds, and traced lines, per input
+TIMEOUT = 1.0
+MAX_LINES = 100000
+
+# Room for the error message of each input
+MESSAGE_SIZE = 200
+
+# status, fitness, message length
+HEADER = struct.Struct('<BdH')
+
+Result = collections.namedtuple('Result', 'status fitness arcs message')
+
+class ForkServer:
+    def __init__(self, run, analysis, fitness=None, timeout=TIMEOUT,
+                 max_lines=MAX_LINES, memory_limit=None, batch_size=BATCH_SIZE):
+        """
+        run(term) runs the target with the input; fitness(coverage), if
+        given, computes the fitness of a coverage record in the child.
+        """
+        self.run = run
+        self.fitness = fitness
+        self.timeout = timeout
+        self.max_lines = max_lines
+        self.memory_limit = memory_limit
+        self.batch_size = batch_size
+        self.edges = tuple(analysis.edges)
+        self.index = {e:i for i, e in enumerate(self.edges)}
+        self.bitmap_size = (len(self.edges) + 7) // 8
+        self.slot_size = HEADER.size + MESSAGE_SIZE + self.bitmap_size
+        # anonymous maps are shared with forked children
+        self.shm = mmap.mmap(-1, self.slot_size * batch_size)
+        # (status, message) -> [first input, count]
+        self.findings = {}
+        # message -> [first input, count], for harness errors
+        self.errors = {}
+        self.executions = 0
+        self.forks = 0
+
+    def _write(self, k, status, fitness=float('nan'), message='', arcs=()):
+        offset = k * self.slot_size
+        msg = message.encode('utf-8', 'replace')[:MESSAGE_SIZE]
+        bitmap = bytearray(self.bitmap_size)
+        for e in arcs:
+            i = self.index.get(e)
+            if i is not None: bitmap[i >> 3] |= 1 << (i & 7)
+        start = offset + HEADER.size
+        self.shm[start:start + len(msg)] = msg
+        start += MESSAGE_SIZE
+        self.shm[start:start + self.bitmap_size] = bytes(bitmap)
+        # the status goes last, so that a result is complete once it is set
+        HEADER.pack_into(self.shm, offset, status, fitness, len(msg))
+
+    def _status(self, k):
+        return self.shm[k * self.slot_size]
+
+    def _read(self, k):
+        offset = k * self.slot_size
+        (status, fitness, length) = HEADER.unpack_from(self.shm, offset)
+        start = offset + HEADER.size
+        message = self.shm[start:start + length].decode('utf-8', 'replace')
+        start += MESSAGE_SIZE
+        bitmap = self.shm[start:start + self.bitmap_size]
+        arcs = {e for i, e in enumerate(self.edges) if bitmap[i >> 3] & (1 << (i & 7))}
+        return Result(status, fitness, arcs, message)
+
+    def _run_one(self, k, term):
+        self.shm[k * self.slot_size] = RUNNING
+        signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            coverage = branchcov.capture_coverage(lambda: self.run(term), self.max_lines)
+            status, message = OK, ''
+        except branchcov.LineBudgetExceeded:
+            coverage = branchcov.coverage_record(branchcov.traceit.cov_arcs)
+            status, message = HANG, 'line budget exceeded'
+        except Exception as e:
+            coverage = branchcov.coverage_record(branchcov.traceit.cov_arcs)
+            status, message = CRASH, '%s: %s' % (type(e).__name__, e)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        fitness = float('nan')
+        if self.fitness is not None:
+            try:
+                fitness = self.fitness(coverage)
+            except Exception as e:
+                # a crash or hang of the target is still reported as such
+                if status == OK:
+                    status, message = ERROR, 'fitness: %s: %s' % (type(e).__name__, e)
+        self._write(k, status, fitness, message, {(i, j) for f, i, j, src, l in coverage[0]})
+
+    def _child(self, terms, start):
+        try:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            if self.memory_limit:
+                import resource
+                resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+            for k in range(start, len(terms)):
+                self._run_one(k, terms[k])
+        finally:
+            os._exit(0)
+
+    def _batch(self, terms):
+        for k in range(len(terms)): self.shm[k * self.slot_size] = PENDING
+        start = 0
+        while start < len(terms):
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0: self._child(terms, start)
+            self.forks += 1
+            (_, wstatus) = os.waitpid(pid, 0)
+            k = next((k for k in range(start, len(terms))
+                      if self._status(k) in (PENDING, RUNNING)), None)
+            if k is None: break
+            # the child died on input k
+            if os.WIFSIGNALED(wstatus):
+                sig = os.WTERMSIG(wstatus)
+                if sig == signal.SIGALRM:
+                    self._write(k, HANG, float('inf'), 'timeout')
+                else:
+                    self._write(k, CRASH, float('inf'), 'killed by signal %d' % sig)
+            else:
+                self._write(k, CRASH, float('inf'), 'exit status %d' % os.WEXITSTATUS(wstatus))
+            start = k + 1
+        return [self._read(k) for k in range(len(terms))]
+
+    def execute(self, terms):
+        """
+        Run the target with each input, and return a Result for each.
+        """
+        results = []
+        for i in range(0, len(terms), self.batch_size):
+            batch = terms[i:i + self.batch_size]
+            for term, result in zip(batch, self._batch(batch)):
+                if result.status == ERROR:
+                    error = self.errors.setdefault(result.message, [term, 0])
+                    error[1] += 1
+                elif result.status != OK:
+                    finding = self.findings.setdefault((result.status, result.message), [term, 0])
+                    finding[1] += 1
+                results.append(result)
+        self.executions += len(terms)
+        return results
+
+if __name__ == "__main__":
+    import time
+    import example
+    import evolvefuzz
+    server = ForkServer(example.cgi_decode, evolvefuzz.analysis, evolvefuzz.coverage_fitness)
+    terms = ['abc', 'a+b%41', '%', 'a%4', '%zz'] * 20
+    start = time.time()
+    results = server.execute(terms)
+    print("%d inputs in %.2fs, %d forks" % (len(terms), time.time() - start, server.forks))
+    for term, result in zip(terms[:5], results):
+        print("%s\t%s\t%s\t%s" % (term, STATUS_NAMES[result.status], result.fitness, result.message))
+    for (status, message), (term, count) in server.findings.items():
+        print("%s: %s (%d times, first %r)" % (STATUS_NAMES[status], message, count, term))
+    for message, (term, count) in server.errors.items():
+        print("error: %s (%d times, first %r)" % (message, count, term))
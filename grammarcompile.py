@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Compile a grammar into a specialized Python producer
+#
+# Each nonterminal becomes a Python function that picks one of its
+# expansions, appends its leading terminals directly to the output, and
+# pushes the rest of the expansion on a work stack, so that strings are
+# produced without building a derivation tree or looking at the grammar
+# dict, and without recursion however deep the input. The strategy is that
+# of grammarfuzz.expand_tree: pick expansions at random while there are
+# fewer than max_symbols nonterminals left to expand, and from then on,
+# pick only the shortest expansions.
+# The generated modules are cached on disk by the hash of the grammar.
+
+import os
+import sys
+import json
+import random
+import hashlib
+import tempfile
+import importlib.util
+from grammarfuzz import CompiledGrammar, compile_grammar, init_tree, expand_tree
+
+# Bump this whenever the generated code changes
+COMPILER_VERSION = 2
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__grammarcache__')
+
+# producers loaded in this process, by grammar hash
+producers = {}
+
+def grammar_hash(grammar):
+    if isinstance(grammar, CompiledGrammar): grammar = grammar.grammar
+    src = json.dumps([COMPILER_VERSION, grammar], sort_keys=True)
+    return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+def generate_source(grammar, start_symbol = "$START"):
+    """
+    The source of the producer module for the grammar.
+    The state st is [number of nonterminals left to expand, max_symbols].
+    Once the limit is reached, max_symbols is set to 0, so that only the
+    shortest expansions are chosen from then on. The stack holds what is
+    left to produce, in reverse: strings, and functions of nonterminals.
+    """
+    compiled = compile_grammar(grammar)
+    names = {nt:'p_%d' % i for i, nt in enumerate(compiled.rules)}
+    lines = ['# Generated by grammarcompile. Do not edit.', '']
+    for nt, rules in compiled.rules.items():
+        shortest = compiled.shortest[nt]
+        lines.append('def %s(out, st, rnd, stack):' % names[nt])
+        lines.append('    # %s' % nt)
+        if len(rules) == 1:
+            lines.append('    if st[0] >= st[1]: st[1] = 0')
+        else:
+            lines.append('    if st[0] < st[1]:')
+            lines.append('        r = int(rnd() * %d)' % len(rules))
+            lines.append('    else:')
+            lines.append('        st[1] = 0')
+            if len(shortest) == 1:
+                lines.append('        r = %d' % shortest[0])
+            else:
+                lines.append('        r = %r[int(rnd() * %d)]' % (tuple(shortest), len(shortest)))
+        for i, rule in enumerate(rules):
+            body = []
+            nts = sum(1 for s, is_nt in rule if is_nt)
+            # this node leaves the frontier, and its nonterminals join it
+            if nts != 1: body.append('st[0] += %d' % (nts - 1))
+            # the leading terminals go to the output, the rest on the stack
+            items, terminals = [], []
+            for s, is_nt in rule + ((None, True),):
+                if not is_nt:
+                    terminals.append(s)
+                    continue
+                if terminals: items.append(repr(''.join(terminals)))
+                elif not items: items.append(None)
+                terminals = []
+                if s is not None: items.append(names[s])
+            leading = items.pop(0)
+            if leading is not None: body.append('out.append(%s)' % leading)
+            if len(items) == 1: body.append('stack.append(%s)' % items[0])
+            elif items: body.append('stack.extend((%s))' % ', '.join(reversed(items)))
+            if not body: body.append('pass')
+            if len(rules) == 1:
+                lines.extend('    %s' % b for b in body)
+            else:
+                lines.append('    %s r == %d:' % ('if' if i == 0 else 'elif', i))
+                lines.extend('        %s' % b for b in body)
+        lines.append('')
+
+    lines.append('FUNCTIONS = {%s}' % ', '.join('%r: %s' % (nt, n) for nt, n in names.items()))
+    lines.append('')
+    lines.append('def produce(rnd, max_symbols = 10, start_symbol = %r):' % start_symbol)
+    lines.append('    out = []')
+    lines.append('    st = [1, max_symbols]')
+    lines.append('    stack = [FUNCTIONS[start_symbol]]')
+    lines.append('    while stack:')
+    lines.append('        item = stack.pop()')
+    lines.append('        if item.__class__ is str: out.append(item)')
+    lines.append('        else: item(out, st, rnd, stack)')
+    lines.append("    return ''.join(out)")
+    lines.append('')
+    return '\n'.join(lines)
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def compile_producer(grammar, cache_dir = CACHE_DIR):
+    """
+    The producer module for the grammar, from this process, from the disk
+    cache, or freshly generated (and then saved to the disk cache).
+    """
+    h = grammar_hash(grammar)
+    if h in producers: return producers[h]
+    name = 'grammar_%s' % h[:16]
+    path = os.path.join(cache_dir, name + '.py') if cache_dir else None
+
+    if path is None or not os.path.exists(path):
+        src = generate_source(grammar)
+        if path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # write and rename, so that concurrent processes never see
+                # a partial module.
+                fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f: f.write(src)
+                os.replace(tmp, path)
+            except OSError:
+                path = None
+        if path is None:
+            # no usable cache; keep the module in memory only
+            module = type(sys)(name)
+            exec(compile(src, name, 'exec'), module.__dict__)
+            producers[h] = module
+            return module
+
+    producers[h] = load_module(name, path)
+    return producers[h]
+
+# Produce a string directly from the grammar
+def produce(grammar, max_symbols = 10, rng = random):
+    return compile_producer(grammar).produce(rng.random, max_symbols)
+
+# Produce a derivation tree. The compiled producers do not build trees, so
+# this uses the tree expansion of grammarfuzz.
+def produce_tree(grammar, max_symbols = 10, rng = random):
+    return expand_tree(init_tree(), grammar, max_symbols, rng)
+
+if __name__ == "__main__":
+    import grammarfuzz
+    grammar = grammarfuzz.term_grammar
+    if len(sys.argv) > 1 and sys.argv[1] == '-s':
+        print(generate_source(grammar))
+    else:
+        for i in range(1, 20):
+            print(produce(grammar))
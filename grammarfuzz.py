@@ -2,6 +2,8 @@
 # Use a grammar to fuzz, using derivation trees
 
 import random
+import array
+import collections
 import re
 
 # We define a grammar as mappings of nonterminals into possible expansions.
@@ -81,38 +83,64 @@ def log(s):
         print(s() if callable(s) else s)
 
 
-# cache the function calls. We only cache a given call based on the
-# indicated argument number per function.
-def memoize(argnum):
-    def fn_wrap(function):
-        memo = {}
-        def wrapper(*args):
-            if args[argnum] in memo: return memo[args[argnum]]
-            rv = function(*args)
-            memo[args[argnum]] = rv
-            return rv
-        return wrapper
-    return fn_wrap
+# Split an expansion into its terminal and nonterminal tokens, such that
+# ''.join(tokens) == expansion
+def tokenize(expansion):
+    return tuple(s for s in re.split(RE_NONTERMINAL, expansion) if s)
+
+# A grammar prepared for expansion. Each expansion is tokenized once, and
+# the exact minimum cost of expanding each rule is computed with a fixpoint
+# over the whole grammar, and stored in a flat per-rule list, so that
+# expanding a node needs only list lookups.
+class CompiledGrammar:
+    def __init__(self, grammar):
+        self.grammar = grammar
+        # nonterminal -> per rule tuple of (token, is_nonterminal)
+        self.rules = {nt:[tuple((s, is_symbol(s)) for s in tokenize(e))
+                          for e in expansions]
+                      for nt, expansions in grammar.items()}
+
+        # The cost of a rule is the sum of the costs of its nonterminals + 1,
+        # and the cost of a nonterminal is that of its cheapest rule.
+        # Iterate until no cost decreases any more.
+        self.min_cost = {nt:float('inf') for nt in grammar}
+        changed = True
+        while changed:
+            changed = False
+            for nt, rules in self.rules.items():
+                cost = min(self.rule_cost(rule) for rule in rules)
+                if cost < self.min_cost[nt]:
+                    self.min_cost[nt] = cost
+                    changed = True
+
+        # nonterminal -> per rule cost, and the indexes of the cheapest rules
+        self.costs = {nt:[self.rule_cost(rule) for rule in rules]
+                      for nt, rules in self.rules.items()}
+        self.shortest = {nt:[i for i, c in enumerate(costs) if c == self.min_cost[nt]]
+                         for nt, costs in self.costs.items()}
+
+    def rule_cost(self, rule):
+        return sum(self.min_cost[s] for s, nt in rule if nt) + 1
+
+    # Fresh children for the rule-th expansion of symbol
+    def children(self, symbol, rule):
+        return [(s, None) if nt else (s, []) for s, nt in self.rules[symbol][rule]]
+
+# A grammar is compiled once, where it enters the API: by the engines
+# and expand_tree. Nothing is cached across calls, so pass the
+# CompiledGrammar along rather than the dict to avoid compiling it again.
+def compile_grammar(grammar):
+    if isinstance(grammar, CompiledGrammar): return grammar
+    return CompiledGrammar(grammar)
 
 # The minimum cost of expansion of this symbol
-@memoize(0) # memoize on the first arg
-def symbol_min_cost(nt, grammar, seen=set()):
-    expansions = grammar[nt]
-    return min(min_expansions(e, grammar, seen | {nt}) for e in expansions)
+def symbol_min_cost(nt, grammar):
+    return compile_grammar(grammar).min_cost[nt]
 
 # The minimum cost of expansion of this rule
-@memoize(0)
-def min_expansions(expansion, grammar, seen=set()):
-    symbols  = [s for s in re.findall(RE_NONTERMINAL, expansion)
-            if is_symbol(s)]
-    # at least one expansion has no variable to expand.
-    if not symbols: return 1
-
-    # if a variable present in the expansion is already in the stack, then it is
-    # recursion
-    if any(s in seen for s in symbols): return float('inf')
-    # the value of a expansion is the sum of all expandable variables inside + 1
-    return sum(symbol_min_cost(s, grammar, seen) for s in symbols) + 1
+def min_expansions(expansion, grammar):
+    grammar = compile_grammar(grammar)
+    return grammar.rule_cost(tuple((s, is_symbol(s)) for s in tokenize(expansion)))
 
 
 # We create a derivation tree with nodes in the form (SYMBOL, CHILDREN)
@@ -134,132 +162,176 @@ def init_tree(start_symbol = "$START"):
 def is_symbol(s):
     return s[0] == '$'
 
-# Convert an expansion rule to children
-@memoize(0)
-def expansion_to_children(expansion):
-    # print("Converting " + repr(expansion))
-    # strings contains all substrings -- both terminals and non-terminals such
-    # that ''.join(strings) == expansion
-    strings  = re.split(RE_NONTERMINAL, expansion)
-    return [(s, None) if is_symbol(s) else (s, []) for s in strings if s]
-
-# Expand a node
-def expand_node(node, grammar, prefer_shortest_expansion):
+# Counts of the expansions produced in a session: how often each
+# (nonterminal, alternative) pair was produced, and each k-path with k = 2,
+# that is, each expansion of a child below an expansion of its parent.
+# Expansions are numbered, so that the counts fit in a flat array and a
+# dict of ints.
+class GrammarCoverage:
+    def __init__(self, grammar):
+        self.grammar = compile_grammar(grammar)
+        self.base = {}
+        self.names = []
+        for nt, expansions in self.grammar.grammar.items():
+            self.base[nt] = len(self.names)
+            self.names.extend((nt, e) for e in expansions)
+        self.counts = array.array('L', [0]) * len(self.names)
+        self.paths = collections.Counter()
+
+    # The number of the rule-th expansion of symbol
+    def expansion(self, symbol, rule):
+        return self.base[symbol] + rule
+
+    def record(self, symbol, rule, parent = None):
+        e = self.base[symbol] + rule
+        self.counts[e] += 1
+        if parent is not None: self.paths[parent * len(self.names) + e] += 1
+        return e
+
+    # Pick one of the candidate rules of symbol, preferring rules never
+    # produced, then rules never produced below the parent expansion.
+    # Once all are covered, the choice is uniform again.
+    def choose(self, symbol, candidates, parent, rng = random):
+        base = self.base[symbol]
+        fresh = [r for r in candidates if not self.counts[base + r]]
+        if not fresh and parent is not None:
+            offset = parent * len(self.names) + base
+            fresh = [r for r in candidates if not self.paths[offset + r]]
+        return rng.choice(fresh or candidates)
+
+    def uncovered(self):
+        return [self.names[e] for e, c in enumerate(self.counts) if not c]
+
+    def coverage(self):
+        return sum(1 for c in self.counts if c) / len(self.counts)
+
+    def path_coverage(self):
+        # the k-paths produced; not every pair is possible in the grammar
+        return len(self.paths)
+
+# Choose the rule to expand symbol with, either from all possible
+# expansions, or from the shortest ones. With a coverage, the choice
+# prefers expansions not produced yet, and is recorded.
+def choose_rule(symbol, grammar, prefer_shortest_expansion, rng = random,
+                coverage = None, parent = None):
+    if prefer_shortest_expansion:
+        candidates = grammar.shortest[symbol]
+    elif coverage is None:
+        return rng.randrange(len(grammar.rules[symbol]))
+    else:
+        candidates = range(len(grammar.rules[symbol]))
+    if coverage is None: return rng.choice(candidates)
+    return coverage.choose(symbol, candidates, parent, rng)
+
+# Expand a node; grammar is a CompiledGrammar
+def expand_node(node, grammar, prefer_shortest_expansion, rng = random,
+                coverage = None, parent = None):
     (symbol, children) = node
     # print("Expanding " + repr(symbol))
     assert children is None
 
-    # Fetch the possible expansions from grammar...
-    expansions = grammar[symbol]
-    possible_children_with_len = [(expansion_to_children(expansion),
-                                   min_expansions(expansion, grammar, {symbol}))
-                                  for expansion in expansions]
-    min_len = min(s[1] for s in possible_children_with_len)
-
-    # ...as well as the shortest ones
-    shortest_children = [child for (child, clen) in possible_children_with_len
-                               if clen == min_len]
-
-    # Pick a child randomly
-    if prefer_shortest_expansion:
-        children = random.choice(shortest_children)
-    else:
-        # TODO: Consider preferring children not expanded yet,
-        # and other forms of grammar coverage (or code coverage)
-        children, _ = random.choice(possible_children_with_len)
+    # Pick a child randomly, either from all possible expansions, or
+    # from the shortest ones -- preferring children not expanded yet
+    # if we track grammar coverage
+    # TODO: Consider other forms of coverage (e.g. code coverage)
+    rule = choose_rule(symbol, grammar, prefer_shortest_expansion, rng, coverage, parent)
+    if coverage is not None: coverage.record(symbol, rule, parent)
 
     # Return with a new list
-    return (symbol, children)
-
-# Count possible expansions -
-# that is, the number of (SYMBOL, None) nodes in the tree
-def possible_expansions(tree):
+    return (symbol, grammar.children(symbol, rule))
+
+# Copy the nodes on the way to unexpanded nodes, so that the copy can be
+# expanded in place without changing trees that share subtrees with it.
+# The unexpanded nodes are added to the frontier as (children, index, parent)
+# slots, where parent is the number of the expansion of the parent in a
+# GrammarCoverage, or None if not known. Returns the copy, and whether it
+# has unexpanded nodes.
+def open_tree(tree, frontier):
     (symbol, children) = tree
-    if children is None:
-        return 1
-
-    number_of_expansions = sum(possible_expansions(c) for c in children)
-    return number_of_expansions
-
-# short circuit. any will return for the first item that is true without
-# evaluating the rest.
-def any_possible_expansions(tree):
-    (symbol, children) = tree
-    if children is None: return True
-
-    return any(any_possible_expansions(c) for c in children)
-
-# Expand the tree once
-def expand_tree_once(tree, grammar, prefer_shortest_expansion):
-    (symbol, children) = tree
-    if children is None:
-        # Expand this node
-        return expand_node(tree, grammar, prefer_shortest_expansion)
-
-    # print("Expanding tree " + repr(tree))
-
-    # Find all children with possible expansions
-    expandable_children = [i for (i, c) in enumerate(children) if any_possible_expansions(c)]
-
-    # Select a random child
-    # TODO: Various heuristics for choosing a child here,
-    # e.g. grammar or code coverage
-    child_to_be_expanded = random.choice(expandable_children)
-
-    # Expand it
-    new_child = expand_tree_once(children[child_to_be_expanded], grammar, prefer_shortest_expansion)
-
-    new_children = (children[:child_to_be_expanded] +
-                    [new_child] +
-                    children[child_to_be_expanded + 1:])
-
-    new_tree = (symbol, new_children)
-
-    # print("Expanding tree " + repr(tree) + " into " + repr(new_tree))
-
-    return new_tree
+    if children is None: return (tree, True)
+
+    new_children = None
+    for i, c in enumerate(children):
+        new_child, is_open = open_tree(c, frontier)
+        if not is_open: continue
+        if new_children is None: new_children = list(children)
+        new_children[i] = new_child
+        if new_child[1] is None: frontier.append((new_children, i, None))
+
+    if new_children is None: return (tree, False)
+    return ((symbol, new_children), True)
+
+# Expand a random node of the frontier in place
+def expand_frontier_once(frontier, grammar, prefer_shortest_expansion, rng = random,
+                         coverage = None):
+    # swap the chosen slot to the end, so that removing it is O(1)
+    i = rng.randrange(len(frontier))
+    frontier[i], frontier[-1] = frontier[-1], frontier[i]
+    (children, index, parent) = frontier.pop()
+
+    symbol = children[index][0]
+    rule = choose_rule(symbol, grammar, prefer_shortest_expansion, rng, coverage, parent)
+    e = None if coverage is None else coverage.record(symbol, rule, parent)
+    new_children = grammar.children(symbol, rule)
+    children[index] = (symbol, new_children)
+    frontier.extend((new_children, j, e) for (j, (s, c)) in enumerate(new_children)
+                    if c is None)
 
 # Keep on applying productions
 # We limit production by the number of minimum expansions
 # alternate limits (e.g. length of overall string) are possible too
-def expand_tree(tree, grammar, max_symbols):
+# rng is the source of randomness (the random module, or a random.Random)
+# coverage, if given, is a GrammarCoverage steering the expansions towards
+# the rules not produced yet in this session
+def expand_tree(tree, grammar, max_symbols, rng = random, coverage = None):
+    grammar = compile_grammar(grammar)
+    # We keep the unexpanded nodes in a frontier, so that picking a node to
+    # expand and counting the possible expansions are both O(1).
+    root = [None]
+    frontier = []
+    root[0], is_open = open_tree(tree, frontier)
+    if root[0][1] is None: frontier.append((root, 0, None))
+
     # Stage 1: Expand until we reach the max number of symbols
     log("Expanding")
-    while 0 < possible_expansions(tree) < max_symbols:
-        tree = expand_tree_once(tree, grammar, False)
-        log(lambda: all_terminals(tree))
+    while 0 < len(frontier) < max_symbols:
+        expand_frontier_once(frontier, grammar, False, rng, coverage)
+        log(lambda: all_terminals(root[0]))
 
     # Stage 2: Keep on expanding, but now focus on the shortest expansions
     log("Closing")
-    while any_possible_expansions(tree):
-        tree = expand_tree_once(tree, grammar, True)
-        log(lambda: all_terminals(tree))
+    while frontier:
+        expand_frontier_once(frontier, grammar, True, rng, coverage)
+        log(lambda: all_terminals(root[0]))
 
-    return tree
+    return root[0]
 
 # The tree as a string
 def all_terminals(tree):
-    (symbol, children) = tree
-    if children is None:
-        # This is a nonterminal symbol not expanded yet
-        return symbol
-
-    if len(children) == 0:
-        # This is a terminal symbol
-        return symbol
-
-    # This is an expanded symbol:
-    # Concatenate all terminal symbols from all children
-    return ''.join([all_terminals(c) for c in children])
+    # We walk the tree with an explicit stack, so that deep trees do not
+    # run into the recursion limit.
+    strings = []
+    stack = [tree]
+    while stack:
+        (symbol, children) = stack.pop()
+        if not children:
+            # This is a terminal symbol, or a nonterminal symbol
+            # not expanded yet
+            strings.append(symbol)
+        else:
+            # This is an expanded symbol:
+            # Concatenate all terminal symbols from all children
+            stack.extend(reversed(children))
+    return ''.join(strings)
 
 # All together
-def produce(grammar, max_symbols = 10):
+def produce(grammar, max_symbols = 10, rng = random, coverage = None):
     # Create an initial derivation tree
     tree = init_tree()
     # print(tree)
 
     # Expand all nonterminals
-    tree = expand_tree(tree, grammar, max_symbols)
+    tree = expand_tree(tree, grammar, max_symbols, rng, coverage)
     # print(tree)
 
     # Return the string
@@ -267,7 +339,7 @@ def produce(grammar, max_symbols = 10):
 
 if __name__ == "__main__":
     # The grammar to use
-    grammar = term_grammar
+    grammar = compile_grammar(term_grammar)
     
     for i in range(1, 20):
         print(produce(grammar))
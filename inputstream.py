@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Streams of generated inputs
+#
+# generate() lazily yields an unbounded stream of inputs (or derivation
+# trees) from a grammar. Streams are seeded per worker, so that the same
+# seed and worker always give the same stream. parallel_generate() fans
+# the generation out over a process pool, and yields the batches in order.
+# Both can drop duplicates, with a set or with a Bloom filter.
+
+import os
+import math
+import random
+import hashlib
+import itertools
+import collections
+import multiprocessing
+import grammarcompile
+from grammarfuzz import compile_grammar, init_tree, expand_tree, all_terminals
+
+# Stop a deduplicated stream after this many duplicates in a row, as the
+# grammar is then (close to) exhausted.
+DEDUP_PATIENCE = 10000
+
+# How many batches each process of the pool works ahead
+BATCHES_AHEAD = 2
+
+def worker_seed(seed, worker):
+    # a stable seed for each (seed, worker) pair
+    return '%s/%d' % (seed, worker)
+
+class BloomFilter:
+    """
+    A set of strings with no false negatives, and false positives at
+    about error_rate once capacity strings are added.
+    """
+    def __init__(self, capacity = 1000000, error_rate = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, s):
+        # double hashing from one digest
+        d = hashlib.blake2b(s.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(d[:8], 'little'), int.from_bytes(d[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, s):
+        for p in self._positions(s):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, s):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(s))
+
+def make_filter(dedup):
+    # dedup is None, 'set', 'bloom', or anything with add and __contains__
+    if dedup is None: return None
+    if dedup == 'set': return set()
+    if dedup == 'bloom': return BloomFilter()
+    return dedup
+
+def deduplicate(items, seen, key):
+    misses = 0
+    for item in items:
+        k = key(item)
+        if k in seen:
+            misses += 1
+            if misses >= DEDUP_PATIENCE: return
+            continue
+        misses = 0
+        seen.add(k)
+        yield item
+
+def _stream(grammar, rng, max_symbols, trees):
+    if trees:
+        grammar = compile_grammar(grammar)
+        while True:
+            yield expand_tree(init_tree(), grammar, max_symbols, rng)
+    else:
+        producer = grammarcompile.compile_producer(grammar)
+        rnd = rng.random
+        while True:
+            yield producer.produce(rnd, max_symbols)
+
+def _key(trees):
+    return all_terminals if trees else (lambda s: s)
+
+def generate(grammar, seed = None, worker = 0, max_symbols = 10, trees = False, dedup = None):
+    """
+    Lazily yield inputs (or derivation trees, if trees is set) from the
+    grammar. A seed of None gives a different stream each time.
+    """
+    if seed is None: seed = int.from_bytes(os.urandom(8), 'little')
+    stream = _stream(grammar, random.Random(worker_seed(seed, worker)), max_symbols, trees)
+    seen = make_filter(dedup)
+    if seen is None: return stream
+    return deduplicate(stream, seen, _key(trees))
+
+def generate_batch(grammar, seed, index, size, max_symbols, trees):
+    stream = _stream(grammar, random.Random(worker_seed(seed, index)), max_symbols, trees)
+    return list(itertools.islice(stream, size))
+
+def _batches(grammar, seed, batch_size, processes, max_symbols, trees):
+    processes = processes or os.cpu_count() or 1
+    with multiprocessing.Pool(processes) as pool:
+        # keep a bounded number of batches in flight, and hand them out in
+        # the order they were asked for.
+        pending = collections.deque()
+        for index in itertools.count():
+            pending.append(pool.apply_async(generate_batch,
+                (grammar, seed, index, batch_size, max_symbols, trees)))
+            if len(pending) >= processes * BATCHES_AHEAD:
+                yield pending.popleft().get()
+
+def parallel_generate(grammar, seed = None, batch_size = 1000, processes = None,
+                      max_symbols = 10, trees = False, dedup = None):
+    """
+    Yield batches of inputs generated by a process pool. Batch i is seeded
+    by (seed, i), so the batches are the same for any number of processes.
+    Deduplication happens here, in order, so it is deterministic too.
+    """
+    if seed is None: seed = int.from_bytes(os.urandom(8), 'little')
+    batches = _batches(grammar, seed, batch_size, processes, max_symbols, trees)
+    seen = make_filter(dedup)
+    if seen is None: return batches
+    key = _key(trees)
+    def dedup_batches():
+        misses = 0
+        for batch in batches:
+            fresh = []
+            for item in batch:
+                k = key(item)
+                if k in seen: continue
+                seen.add(k)
+                fresh.append(item)
+            misses = 0 if fresh else misses + len(batch)
+            if misses >= DEDUP_PATIENCE: return
+            yield fresh
+    return dedup_batches()
+
+if __name__ == "__main__":
+    import argparse
+    import grammarfuzz
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=20, help='number of inputs')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='the seed')
+    parser.add_argument('-g', '--grammar', default='term_grammar', help='grammar in grammarfuzz')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='use a process pool')
+    parser.add_argument('-u', '--unique', action='store_true', help='drop duplicates')
+    args = parser.parse_args()
+    grammar = getattr(grammarfuzz, args.grammar)
+    dedup = 'set' if args.unique else None
+    if args.processes:
+        batches = parallel_generate(grammar, args.seed, processes=args.processes, dedup=dedup)
+        inputs = itertools.chain.from_iterable(batches)
+    else:
+        inputs = generate(grammar, args.seed, dedup=dedup)
+    for s in itertools.islice(inputs, args.count):
+        print(s)
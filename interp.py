@@ -59,16 +59,17 @@ class ExprInterpreter:
           ast.Or: lambda a, b: a or b
         }
 
-        self.symtable = builtins.__dict__
-
-        self.symtable.update(symtable)
+        # names not in the symtable are looked up in the builtins. We do
+        # not update the builtins themselves, so that interpreters with
+        # different symtables can be used side by side.
+        self.symtable = symtable
 
     def walk(self, node):
         if node is None: return
         res = "on_%s" % node.__class__.__name__.lower()
         if hasattr(self, res):
             return getattr(self,res)(node)
-        raise Exception('walk: Not Implemented %s' % type(node))
+        raise NotImplementedError('walk: Not Implemented %s' % type(node))
 
     def on_module(self, node):
         """
@@ -118,11 +119,19 @@ class ExprInterpreter:
         """
         return node.value
 
+    def on_constant(self, node):
+        """
+        Constant(constant value) -- all literals from Python 3.8 on
+        """
+        return node.value
+
     def on_name(self, node):
         """
         Name(identifier id, expr_context ctx)
         """
-        return self.symtable[node.id]
+        if node.id in self.symtable: return self.symtable[node.id]
+        if node.id in builtins.__dict__: return builtins.__dict__[node.id]
+        raise NameError('name %r is not defined' % node.id)
 
     def on_expr(self, node):
         """
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Island model evolution
+#
+# Each island is a worker process evolving a population of its own. After
+# every epoch of a few generations, an island sends its best individuals
+# and the branches its new individuals cover to the coordinator over a
+# pipe. The coordinator keeps a global archive of the input covering each
+# branch of the target function, passes the migrants on to the next island
+# of the ring, and sends every island the archive entries it has not seen.
+# Inputs of the archive covering branches an island has not covered itself
+# migrate into it as well. The coordinator stops the islands once their
+# epochs are done or all branches are covered.
+
+import os
+import random
+import multiprocessing
+import multiprocessing.connection
+import evolvefuzz
+import mutators
+import earleyparse
+import mosa
+from grammarfuzz import all_terminals, compile_grammar
+
+# Generations per epoch, between migrations
+MIGRATION_INTERVAL = 5
+
+# How many of the best individuals migrate
+MIGRANTS = 3
+
+def target_branches():
+    # the branches of the target function
+    target = evolvefuzz.target
+    return set(mosa.branches(target.analysis, {target.function_name}))
+
+def archive_migrants(grammar, archive, covered, limit):
+    # individuals from inputs of the archive covering branches not in covered
+    terms = list(dict.fromkeys(term for arc, term in archive.items() if arc not in covered))
+    trees = list(earleyparse.parse_corpus(grammar, terms[:limit]))
+    return list(zip(trees, evolvefuzz.evaluate(trees)))
+
+def immigrate(pop, migrants):
+    # migrants replace the worst individuals, unless already present
+    terms = {all_terminals(tree) for (tree, fitness) in pop}
+    fresh = [m for m in migrants if all_terminals(m[0]) not in terms]
+    if not fresh: return pop
+    pop = sorted(pop, key=evolvefuzz.by_fitness)[:len(pop) - len(fresh)]
+    return pop + fresh
+
+def run_island(index, conn, grammar, seed, generations, migrants, seeds):
+    random.seed('%s/%d' % (seed, index))
+    grammar = compile_grammar(grammar)
+    mutator = mutators.Mutator(grammar)
+    branches = target_branches()
+    pop = evolvefuzz.population(grammar, seeds)
+    seen = set()
+    # the branches this island covered, and the global archive as far as
+    # the coordinator told us
+    covered = set()
+    archive = {}
+    epoch = 0
+    while True:
+        for i in range(generations):
+            pop = evolvefuzz.evolve(pop, grammar, mutator)
+        epoch += 1
+        # the coverage of the individuals not reported yet; evolve has just
+        # run them, so their edges come from the fitness cache
+        terms = [t for t in dict.fromkeys(all_terminals(tree) for (tree, fitness) in pop)
+                 if t not in seen]
+        seen.update(terms)
+        coverage = {}
+        for term, (fitness, edges) in zip(terms, evolvefuzz.evaluate_results(terms)):
+            for arc in branches.intersection(edges):
+                covered.add(arc)
+                if arc not in archive: coverage.setdefault(arc, term)
+        best = sorted(pop, key=evolvefuzz.by_fitness)[:migrants]
+        conn.send(('epoch', index, epoch, best, coverage))
+        message = conn.recv()
+        if message[0] == 'stop': break
+        (kind, arrivals, updates) = message
+        archive.update(updates)
+        arrivals = arrivals + archive_migrants(grammar, updates, covered, migrants)
+        pop = immigrate(pop, arrivals)
+    conn.close()
+
+class Coordinator:
+    def __init__(self, grammar, islands=None, epochs=10, generations=MIGRATION_INTERVAL,
+                 migrants=MIGRANTS, seed=None, seeds=(), report=print):
+        self.grammar = grammar
+        self.islands = islands or os.cpu_count() or 1
+        self.epochs = epochs
+        self.generations = generations
+        self.migrants = migrants
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self.seeds = list(seeds)
+        self.report = report
+        self.edges = target_branches()
+        # branch -> the first input reported to cover it
+        self.archive = {}
+        # the archive entries in the order they were added, and how many of
+        # them each island was sent
+        self.entries = []
+        self.sent = [0] * self.islands
+        # island -> the best individual it reported last
+        self.best = {}
+
+    def complete(self):
+        return len(self.archive) == len(self.edges)
+
+    def run(self):
+        pipes, processes = [], []
+        for i in range(self.islands):
+            (parent, child) = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=run_island,
+                args=(i, child, self.grammar, self.seed, self.generations,
+                      self.migrants, self.seeds))
+            p.start()
+            child.close()
+            pipes.append(parent)
+            processes.append(p)
+
+        # the migrants on their way to each island
+        inbox = [[] for i in range(self.islands)]
+        active = {conn:i for i, conn in enumerate(pipes)}
+        try:
+            while active:
+                for conn in multiprocessing.connection.wait(list(active)):
+                    try:
+                        (kind, i, epoch, best, coverage) = conn.recv()
+                    except EOFError:
+                        # the island died; the others go on without it
+                        i = active.pop(conn)
+                        processes[i].join()
+                        self.report("island %d died (exit code %r)" % (i, processes[i].exitcode))
+                        continue
+                    for arc, term in coverage.items():
+                        if arc in self.archive: continue
+                        self.archive[arc] = term
+                        self.entries.append((arc, term))
+                    self.best[i] = best[0]
+                    inbox[(i + 1) % self.islands].extend(best)
+                    self.report("island %d epoch %d: best %s, %d/%d branches covered" %
+                                (i, epoch, repr(best[0][1]), len(self.archive), len(self.edges)))
+                    if epoch >= self.epochs or self.complete():
+                        conn.send(('stop',))
+                        del active[conn]
+                    else:
+                        conn.send(('migrants', inbox[i], dict(self.entries[self.sent[i]:])))
+                        inbox[i] = []
+                        self.sent[i] = len(self.entries)
+        finally:
+            # islands still active when we leave early are stopped
+            for p in processes:
+                if active and p.is_alive(): p.terminate()
+                p.join()
+        return self.archive
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--islands', type=int, default=None, help='number of islands')
+    parser.add_argument('-e', '--epochs', type=int, default=10, help='epochs per island')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='the seed')
+    args = parser.parse_args()
+    coordinator = Coordinator(evolvefuzz.cgi_grammar, args.islands, args.epochs, seed=args.seed)
+    archive = coordinator.run()
+    for arc, term in sorted(archive.items()):
+        print("%s\t%s" % (repr(arc), term))
+    evolvefuzz.print_population(list(coordinator.best.values()))
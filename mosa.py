@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Many-objective branch coverage (DynaMOSA)
+#
+# Each uncovered branch of the CFG is an objective of its own. An objective
+# is only targeted once a branch it is control dependent on is covered, and
+# the population is selected by preference sorting and Pareto rank over the
+# active objectives. The best input for each branch is kept in an archive.
+
+import random
+import math
+import branchfitness
+import evolvefuzz
+from grammarfuzz import all_terminals, compile_grammar
+
+# Number of elements in our population
+POPULATION_SIZE = 20
+
+# How many individuals take part in a tournament
+TOURNAMENT_SIZE = 2
+
+def branches(analysis, functions=None):
+    # the edges out of nodes with at least two successors, optionally only
+    # those in the given functions.
+    return [(p, l) for (p, l) in analysis.edges
+            if len(analysis.cfg[p]['children']) > 1 and
+            (functions is None or analysis.cfg[p].get('function') in functions)]
+
+def branch_dependencies(analysis, targets):
+    """
+    The control dependence graph on branches: the branch (p, l) depends on
+    (b, s) if p is control dependent on b, and reached when b goes to s.
+    """
+    deps = {}
+    for (p, l) in targets:
+        deps[(p, l)] = {(b, s) for (b, s) in targets
+                        if analysis.a_control_dependent_on_b(p, b)
+                        and p in analysis.postdom[s]}
+    return deps
+
+class Individual:
+    __slots__ = ('tree', 'term', 'arcs', 'distances', 'fitness', 'rank', 'distance')
+    def __init__(self, tree, term, arcs, distances):
+        self.tree = tree
+        self.term = term
+        self.arcs = arcs
+        self.distances = distances
+        self.fitness = {}
+        self.rank = 0
+        self.distance = 0.0
+
+class DynaMOSA:
+    def __init__(self, analysis, grammar, execute=evolvefuzz.execute,
+                 functions=None, population_size=POPULATION_SIZE):
+        self.analysis = analysis
+        self.grammar = compile_grammar(grammar)
+        self.execute = execute
+        self.population_size = population_size
+        self.targets = branches(analysis, functions)
+        self.deps = branch_dependencies(analysis, self.targets)
+        # branch -> the input that covers it
+        self.archive = {}
+        self.active = set()
+        self.executions = 0
+
+    def evaluate(self, tree):
+        term = all_terminals(tree)
+        coverage = self.execute(term)
+        self.executions += 1
+        arcs = {(i,j) for f,i,j,src,l in coverage[0]}
+        # the distance table is all we need to keep of the execution to
+        # compute the fitness of objectives that are activated later.
+        distances = branchfitness.distance_table(self.analysis, coverage)
+        ind = Individual(tree, term, arcs, distances)
+        self.update_archive(ind)
+        return ind
+
+    def update_archive(self, ind):
+        for t in self.targets:
+            if t not in ind.arcs: continue
+            # prefer shorter inputs for covered branches
+            if t not in self.archive or len(ind.term) < len(self.archive[t]):
+                self.archive[t] = ind.term
+
+    def update_objectives(self):
+        # activate the uncovered branches whose controlling branches are
+        # covered (or that have none).
+        self.active = {t for t in self.targets if t not in self.archive and
+                       (not self.deps[t] or any(d in self.archive for d in self.deps[t]))}
+
+    def objective(self, ind, t):
+        if t not in ind.fitness:
+            ind.fitness[t] = branchfitness.edge_fitness(self.analysis, ind.distances, t)
+        return ind.fitness[t]
+
+    def dominates(self, a, b, objectives):
+        better = False
+        for t in objectives:
+            fa, fb = self.objective(a, t), self.objective(b, t)
+            if fa > fb: return False
+            if fa < fb: better = True
+        return better
+
+    def preference_sort(self, pop):
+        """
+        Front 0 holds the best individual for each active objective. The
+        rest are ranked by non-dominated sorting on the active objectives.
+        """
+        objectives = sorted(self.active)
+        first = set()
+        for t in objectives:
+            best = min(pop, key=lambda i: (self.objective(i, t), len(i.term)))
+            first.add(id(best))
+        fronts = [[i for i in pop if id(i) in first]]
+        rest = [i for i in pop if id(i) not in first]
+
+        dominated_by = {id(i):[] for i in rest}
+        count = {id(i):0 for i in rest}
+        for a in rest:
+            for b in rest:
+                if self.dominates(a, b, objectives): dominated_by[id(a)].append(b)
+                elif self.dominates(b, a, objectives): count[id(a)] += 1
+        front = [i for i in rest if count[id(i)] == 0]
+        while front:
+            fronts.append(front)
+            nxt = []
+            for a in front:
+                for b in dominated_by[id(a)]:
+                    count[id(b)] -= 1
+                    if count[id(b)] == 0: nxt.append(b)
+            front = nxt
+        fronts = [f for f in fronts if f]
+        for rank, front in enumerate(fronts):
+            for i in front: i.rank = rank
+            self.crowding_distance(front, objectives)
+        return fronts
+
+    def crowding_distance(self, front, objectives):
+        for i in front: i.distance = 0.0
+        for t in objectives:
+            front.sort(key=lambda i: self.objective(i, t))
+            lo, hi = self.objective(front[0], t), self.objective(front[-1], t)
+            front[0].distance = front[-1].distance = math.inf
+            if hi == lo: continue
+            for k in range(1, len(front) - 1):
+                front[k].distance += (self.objective(front[k+1], t) -
+                                      self.objective(front[k-1], t)) / (hi - lo)
+
+    def select(self, pop):
+        # tournament on (rank, crowding distance)
+        candidates = random.sample(pop, min(TOURNAMENT_SIZE, len(pop)))
+        return min(candidates, key=lambda i: (i.rank, -i.distance))
+
+    def next_population(self, pop):
+        fronts = self.preference_sort(pop)
+        next_pop = []
+        for front in fronts:
+            if len(next_pop) + len(front) <= self.population_size:
+                next_pop.extend(front)
+                continue
+            front.sort(key=lambda i: -i.distance)
+            next_pop.extend(front[:self.population_size - len(next_pop)])
+            break
+        return next_pop
+
+    def search(self, budget):
+        """
+        Evolve until all branches are covered, or the budget (number of
+        executions) is used up. Returns the archive.
+        """
+        pop = [self.evaluate(evolvefuzz.produce(self.grammar))
+               for i in range(self.population_size)]
+        self.update_objectives()
+        pop = self.next_population(pop)
+        while self.active and self.executions < budget:
+            offspring = [self.evaluate(evolvefuzz.mutate(self.select(pop).tree, self.grammar))
+                         for i in range(self.population_size)]
+            self.update_objectives()
+            pop = self.next_population(pop + offspring)
+        return self.archive
+
+    def uncovered(self):
+        return [t for t in self.targets if t not in self.archive]
+
+if __name__ == "__main__":
+    import sys
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    mosa = DynaMOSA(evolvefuzz.analysis, evolvefuzz.cgi_grammar, functions={'cgi_decode'})
+    archive = mosa.search(budget)
+    print("Executions: %d" % mosa.executions)
+    for t in sorted(archive):
+        print("%s\t%s" % (repr(t), repr(archive[t])))
+    print("Uncovered: %s" % repr(mosa.uncovered()))
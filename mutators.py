@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Mutation operators on derivation trees
+#
+# Each operator picks an expanded nonterminal node of a tree and replaces
+# it by a subtree for the same nonterminal:
+# - regenerate: a freshly expanded subtree
+# - crossover: a subtree of another member of the population
+# - splice: a fragment from a pool of subtrees, indexed by nonterminal
+# New trees share all subtrees off the path to the replaced node. The
+# operator to apply is picked by weight, and the weights adapt to how often
+# each operator yields a child strictly fitter (lower fitness) than its
+# parent. This is the one rule for all engines (see Mutator.reward): which
+# children an engine keeps is up to it, but ties, and children kept for
+# other reasons (e.g. new edges in powerschedule), are no improvement.
+
+import random
+from grammarfuzz import expand_tree, all_terminals, compile_grammar
+
+# The operators, and their initial weights
+WEIGHTS = {'regenerate': 1.0, 'crossover': 1.0, 'splice': 1.0}
+
+# How many fragments to keep per nonterminal, and to take from each tree
+FRAGMENTS_PER_SYMBOL = 100
+FRAGMENTS_PER_TREE = 10
+
+def expanded_nodes(tree):
+    """
+    The expanded nonterminal nodes of the tree, in breadth first order, as
+    (node, entry of the parent, index in the parent). The root is entry 0.
+    """
+    entries = [(tree, -1, -1)]
+    k = 0
+    while k < len(entries):
+        (node, parent, index) = entries[k]
+        for i, c in enumerate(node[1]):
+            if c[1]: entries.append((c, k, i))
+        k += 1
+    return entries
+
+def replace_node(entries, k, new):
+    # a copy of the tree, with the node of entry k replaced by new
+    while True:
+        (node, parent, index) = entries[k]
+        if parent == -1: return new
+        (symbol, children) = entries[parent][0]
+        children = list(children)
+        children[index] = new
+        new = (symbol, children)
+        k = parent
+
+class FragmentPool:
+    """
+    Subtrees of the trees seen so far, by nonterminal. Once a nonterminal
+    has max_per_symbol fragments, new ones replace random old ones.
+    """
+    def __init__(self, max_per_symbol=FRAGMENTS_PER_SYMBOL,
+                 per_tree=FRAGMENTS_PER_TREE, rng=random):
+        self.max_per_symbol = max_per_symbol
+        self.per_tree = per_tree
+        self.rng = rng
+        self.fragments = {}
+        self.strings = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['rng'] = None if self.rng is random else self.rng
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None: self.rng = random
+
+    def add(self, fragment):
+        symbol = fragment[0]
+        s = all_terminals(fragment)
+        strings = self.strings.setdefault(symbol, set())
+        if s in strings: return
+        fragments = self.fragments.setdefault(symbol, [])
+        if len(fragments) < self.max_per_symbol:
+            fragments.append(fragment)
+        else:
+            i = self.rng.randrange(len(fragments))
+            strings.discard(all_terminals(fragments[i]))
+            fragments[i] = fragment
+        strings.add(s)
+
+    def add_tree(self, tree):
+        entries = expanded_nodes(tree)
+        for (node, parent, index) in self.rng.sample(entries, min(self.per_tree, len(entries))):
+            self.add(node)
+
+    def sample(self, symbol):
+        fragments = self.fragments.get(symbol)
+        return self.rng.choice(fragments) if fragments else None
+
+class Mutator:
+    def __init__(self, grammar, weights=None, max_symbols=10, pool=None,
+                 adapt=True, rng=random):
+        self.grammar = compile_grammar(grammar)
+        self.max_symbols = max_symbols
+        self.rng = rng
+        self.pool = pool if pool is not None else FragmentPool(rng=rng)
+        self.adapt = adapt
+        self._operators()
+        self.weights = dict(WEIGHTS)
+        self.weights.update(weights or {})
+        self.uses = {name:0 for name in self.operators}
+        self.gains = {name:0 for name in self.operators}
+
+    def _operators(self):
+        self.operators = {'regenerate': self.regenerate,
+                          'crossover': self.crossover,
+                          'splice': self.splice}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['operators']
+        state['rng'] = None if self.rng is random else self.rng
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None: self.rng = random
+        self._operators()
+
+    def _pick(self, tree):
+        entries = expanded_nodes(tree)
+        return entries, self.rng.randrange(len(entries))
+
+    def regenerate(self, tree, population):
+        entries, k = self._pick(tree)
+        symbol = entries[k][0][0]
+        new = expand_tree((symbol, None), self.grammar, self.max_symbols, self.rng)
+        return replace_node(entries, k, new)
+
+    def crossover(self, tree, population):
+        # a subtree of the same nonterminal from another individual
+        donors = [t for t in population if t is not tree]
+        if not donors: return None
+        entries, k = self._pick(tree)
+        symbol = entries[k][0][0]
+        donor = self.rng.choice(donors)
+        matches = [node for (node, parent, index) in expanded_nodes(donor)
+                   if node[0] == symbol]
+        if not matches: return None
+        return replace_node(entries, k, self.rng.choice(matches))
+
+    def splice(self, tree, population):
+        entries, k = self._pick(tree)
+        fragment = self.pool.sample(entries[k][0][0])
+        if fragment is None: return None
+        return replace_node(entries, k, fragment)
+
+    def weight(self, name):
+        # the initial weight, scaled by the (smoothed) rate of improvements
+        if not self.adapt: return self.weights[name]
+        return self.weights[name] * (self.gains[name] + 1) / (self.uses[name] + 2)
+
+    def mutate(self, tree, population=()):
+        """
+        Apply an operator picked by weight, and return (operator, child).
+        Operators that cannot apply fall back to regenerate.
+        """
+        names = list(self.operators)
+        name = self.rng.choices(names, [self.weight(n) for n in names])[0]
+        child = self.operators[name](tree, population)
+        if child is None:
+            name = 'regenerate'
+            child = self.regenerate(tree, population)
+        return name, child
+
+    def reward(self, name, child_fitness, parent_fitness):
+        # credit the operator that produced a child; lower is fitter
+        self.uses[name] += 1
+        if child_fitness < parent_fitness: self.gains[name] += 1
+
+    def add(self, tree):
+        self.pool.add_tree(tree)
+
+if __name__ == "__main__":
+    import grammarfuzz
+    grammar = compile_grammar(grammarfuzz.term_grammar)
+    mutator = Mutator(grammar)
+    population = [expand_tree(grammarfuzz.init_tree(), grammar, 10) for i in range(10)]
+    for tree in population: mutator.add(tree)
+    for tree in population:
+        name, child = mutator.mutate(tree, population)
+        print("%s\t%s -> %s" % (name, all_terminals(tree), all_terminals(child)))
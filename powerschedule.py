@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Power schedules
+#
+# Instead of picking parents uniformly, each individual gets an energy: the
+# number of children to breed from it when it is picked, and the weight
+# with which it is picked. As in AFLFast, the energy grows with the number
+# of times s(i) the individual was picked, and shrinks with the frequency
+# f(i) of what it exercises -- here, the number of executions that hit the
+# rarest edge it covers. Individuals exercising rare edges thus get most of
+# the executions. The energies are kept in a Fenwick tree, so that picking
+# an individual and updating its energy are O(log n). Frequencies change
+# with every execution; the energy of an individual is brought up to date
+# when it is picked, and all of them every REFRESH_INTERVAL executions.
+
+import random
+import evolvefuzz
+from grammarfuzz import all_terminals, compile_grammar
+
+# The energy of an individual picked for the first time (alpha / beta), and
+# the most energy an individual can get (M)
+BASE_ENERGY = 4
+MAX_ENERGY = 64
+
+# Recompute all energies after this many executions
+REFRESH_INTERVAL = 500
+
+SCHEDULES = ('exploit', 'explore', 'coe', 'fast', 'lin', 'quad')
+
+class FenwickTree:
+    """
+    Weights with O(log n) updates, prefix sums, and sampling.
+    """
+    def __init__(self, weights=()):
+        self.weights = list(weights)
+        self.tree = [0.0] * (len(self.weights) + 1)
+        for i, w in enumerate(self.weights):
+            self._add(i, w)
+
+    def _add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        # the new node i covers the range (i - lowbit(i), i]
+        i = len(self.tree)
+        total = weight
+        j = 1
+        while j < (i & -i):
+            total += self.tree[i - j]
+            j <<= 1
+        self.tree.append(total)
+        self.weights.append(weight)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __setitem__(self, i, weight):
+        self._add(i, weight - self.weights[i])
+        self.weights[i] = weight
+
+    def __getitem__(self, i):
+        return self.weights[i]
+
+    def total(self):
+        # the sum of all weights
+        s, i = 0.0, len(self.weights)
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def find(self, x):
+        # the first index whose prefix sum exceeds x
+        i, step = 0, 1
+        while step * 2 < len(self.tree): step *= 2
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] <= x:
+                i += step
+                x -= self.tree[i]
+            step //= 2
+        return min(i, len(self.weights) - 1)
+
+    def sample(self, rng=random):
+        return self.find(rng.random() * self.total())
+
+class Seed:
+    __slots__ = ('tree', 'term', 'edges', 'fitness', 'picked')
+    def __init__(self, tree, term, edges, fitness):
+        self.tree = tree
+        self.term = term
+        self.edges = edges
+        self.fitness = fitness
+        self.picked = 0
+
+class PowerSchedule:
+    def __init__(self, schedule='fast', base=BASE_ENERGY, limit=MAX_ENERGY, rng=random):
+        if schedule not in SCHEDULES: raise ValueError('unknown schedule %r' % schedule)
+        self.schedule = schedule
+        self.base = base
+        self.limit = limit
+        self.rng = rng
+        self.seeds = []
+        self.weights = FenwickTree()
+        # edge -> number of executions hitting it
+        self.hits = {}
+        self.executions = 0
+        self.refreshed = 0
+
+    def frequency(self, seed):
+        return min((self.hits.get(e, 0) for e in seed.edges), default=self.executions) or 1
+
+    def energy(self, seed):
+        s, f, p = min(seed.picked, 30), self.frequency(seed), self.base
+        # exploit spends as much as AFL on every seed, explore a constant base
+        if self.schedule == 'exploit': return self.limit
+        if self.schedule == 'explore': return p
+        if self.schedule == 'coe':
+            # cut-off exponential: no energy for high frequency paths
+            mean = self.executions / max(1, len(self.hits))
+            if f > mean: return 0
+            return min(p * 2 ** s, self.limit)
+        if self.schedule == 'fast': e = p * 2 ** s / f
+        elif self.schedule == 'lin': e = p * s / f
+        else: e = p * s * s / f
+        return max(1, min(int(e), self.limit))
+
+    def record(self, edges):
+        # count an execution
+        self.executions += 1
+        for e in edges: self.hits[e] = self.hits.get(e, 0) + 1
+
+    def add(self, tree, term, edges, fitness):
+        seed = Seed(tree, term, edges, fitness)
+        self.seeds.append(seed)
+        self.weights.append(self.energy(seed))
+        return seed
+
+    def refresh(self):
+        self.weights = FenwickTree(self.energy(seed) for seed in self.seeds)
+        self.refreshed = self.executions
+
+    def choose(self):
+        """
+        Pick a seed by energy, and return it with the number of children
+        to breed from it.
+        """
+        if self.executions - self.refreshed >= REFRESH_INTERVAL: self.refresh()
+        if self.weights.total() > 0:
+            i = self.weights.sample(self.rng)
+        else:
+            i = self.rng.randrange(len(self.seeds))
+        seed = self.seeds[i]
+        seed.picked += 1
+        energy = self.energy(seed)
+        self.weights[i] = energy
+        return seed, max(1, energy)
+
+def fuzz(grammar, executions, schedule='fast', seeds=(), pool=None, mutator=None):
+    """
+    Breed children of seeds picked by the power schedule; children covering
+    a new edge, or fitter than their parent, become seeds themselves.
+    """
+    grammar = compile_grammar(grammar)
+    power = PowerSchedule(schedule)
+    pop = evolvefuzz.population(grammar, seeds, pool)
+    terms = [all_terminals(tree) for (tree, fitness) in pop]
+    for (tree, fitness), term, (_, edges) in zip(pop, terms, evolvefuzz.evaluate_results(terms, pool)):
+        power.record(edges)
+        power.add(tree, term, edges, fitness)
+    known = set(terms)
+    while power.executions < executions:
+        seed, energy = power.choose()
+        energy = min(energy, executions - power.executions)
+        if mutator is None:
+            children = [evolvefuzz.mutate(seed.tree, grammar) for i in range(energy)]
+        else:
+            trees = [s.tree for s in power.seeds]
+            bred = [mutator.mutate(seed.tree, trees) for i in range(energy)]
+            children = [child for (operator, child) in bred]
+        terms = [all_terminals(child) for child in children]
+        results = evolvefuzz.evaluate_results(terms, pool)
+        for i, (child, term, (fitness, edges)) in enumerate(zip(children, terms, results)):
+            new = any(e not in power.hits for e in edges)
+            power.record(edges)
+            if mutator is not None:
+                mutator.reward(bred[i][0], fitness, seed.fitness)
+            if term not in known and (new or fitness < seed.fitness):
+                known.add(term)
+                power.add(child, term, edges, fitness)
+                if mutator is not None: mutator.add(child)
+    return power
+
+if __name__ == "__main__":
+    import sys
+    schedule = sys.argv[1] if len(sys.argv) > 1 else 'fast'
+    power = fuzz(evolvefuzz.cgi_grammar, 1000, schedule)
+    print("%d seeds, %d edges covered in %d executions" %
+          (len(power.seeds), len(power.hits), power.executions))
+    for e, n in sorted(power.hits.items(), key=lambda h: h[1])[:5]:
+        print("%s hit %d times, first by %r" % (repr(e), n, evolvefuzz.coverage_archive.get(e)))
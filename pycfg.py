@@ -8,8 +8,8 @@ Use http://viz-js.com/ to view digraph output
 
 import ast
 import re
+import collections
 import astunparse
-import pygraphviz
 
 class CFGNode(dict):
     registry = 0
@@ -68,6 +68,8 @@ class CFGNode(dict):
             for i in ['if', 'while', 'for', 'elif']:
                 v = re.sub(r'^_%s:' % i, '%s:' % i, v)
             return v
+        # only needed for drawing, so it is imported here
+        import pygraphviz
         G = pygraphviz.AGraph(directed=True)
         cov_lines = [i for i,j in arcs]
         for nid, cnode in CFGNode.cache.items():
@@ -367,11 +369,46 @@ def compute_dominator(cfg, start = 0, key='parents'):
             dominator[n] = v
     return dominator
 
+def compute_path_tree(cfg, start=0, key='parents'):
+    """
+    The shortest path tree from start, computed once per CFG by a breadth
+    first search. Maps each reachable node to its predecessor on a
+    shortest path from start (start maps to None). The edges are followed
+    in the reverse of key, so that paths agree with the parents relation.
+    """
+    successors = {n:set() for n in cfg}
+    for n in cfg:
+        for p in cfg[n][key]:
+            successors.setdefault(p, set()).add(n)
+    tree = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        n = queue.popleft()
+        for c in sorted(successors[n]):
+            if c in tree: continue
+            tree[c] = n
+            queue.append(c)
+    return tree
+
+def get_path(tree, node):
+    """
+    The shortest path from the start of the tree to node, in O(path length).
+    Unreachable nodes get just themselves as the path.
+    """
+    path = [node]
+    while tree.get(path[-1]) is not None:
+        path.append(tree[path[-1]])
+    path.reverse()
+    return path
+
 def slurp(f):
     with open(f, 'r') as f: return f.read()
 
 
 def get_cfg(pythonfile):
+    # start from no nodes, so that each file is analyzed on its own
+    CFGNode.cache = {}
+    CFGNode.registry = 0
     cfg = PyCFG()
     cfg.gen_cfg(slurp(pythonfile).strip())
     cache = CFGNode.cache
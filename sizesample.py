@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Uniform sampling of strings of an exact size
+#
+# We count, for each nonterminal, how many derivations it has for each size
+# (length of the string), and then draw a derivation of the requested size
+# uniformly at random: each rule, and each split of the size among the
+# symbols of a rule, is picked with probability proportional to the number
+# of derivations it leaves. The counts are exact (Python integers).
+#
+# The grammar may not derive the empty string, and may not have cycles of
+# rules with a single nonterminal (e.g. $A -> $B, $B -> $A), as either
+# makes the number of derivations of a size infinite.
+
+import random
+from grammarfuzz import CompiledGrammar
+
+class SizeSampler:
+    def __init__(self, grammar, start_symbol = "$START"):
+        self.start_symbol = start_symbol
+        self.rules = CompiledGrammar(grammar).rules
+        for nt, rules in self.rules.items():
+            if any(not rule for rule in rules):
+                raise ValueError('%s has an empty expansion' % nt)
+        self.order = self._unit_order()
+        # counts[nt][n] is the number of derivations of nt of size n, and
+        # suffixes[nt][r][i][n] that of the symbols i.. of the rule r.
+        self.counts = {nt:[] for nt in self.rules}
+        self.suffixes = {nt:[[[] for i in rule] for rule in rules]
+                         for nt, rules in self.rules.items()}
+        self.size = -1
+
+    def _unit_order(self):
+        # Order the nonterminals such that nt comes after B for each rule
+        # nt -> B, as these two have counts of the same size.
+        order, state = [], {}
+        for root in self.rules:
+            if root in state: continue
+            state[root] = 1
+            stack = [(root, self._units(root))]
+            while stack:
+                nt, units = stack[-1]
+                for b in units:
+                    if state.get(b) == 1:
+                        raise ValueError('cycle of single nonterminal rules at %s' % b)
+                    if b not in state:
+                        state[b] = 1
+                        stack.append((b, self._units(b)))
+                        break
+                else:
+                    stack.pop()
+                    state[nt] = 2
+                    order.append(nt)
+        return order
+
+    def _units(self, nt):
+        return iter([rule[0][0] for rule in self.rules[nt]
+                     if len(rule) == 1 and rule[0][1]])
+
+    def _split(self, nt, r, i, n):
+        # the derivations of size n of the symbols i.. of rule r. Only the
+        # last symbol may take all of n; the others take less, and hence
+        # use the tables of the smaller sizes.
+        rule = self.rules[nt][r]
+        s, is_nt = rule[i]
+        if i == len(rule) - 1:
+            if is_nt: return self.counts[s][n]
+            return 1 if n == len(s) else 0
+        rest = self.suffixes[nt][r][i+1]
+        if not is_nt:
+            return rest[n - len(s)] if n >= len(s) else 0
+        counts = self.counts[s]
+        return sum(counts[m] * rest[n - m] for m in range(1, n))
+
+    def extend(self, size):
+        # compute the tables up to size
+        for n in range(self.size + 1, size + 1):
+            for nt in self.order:
+                # the derivations of each rule, kept for picking rules
+                firsts = self.suffixes[nt]
+                for r in range(len(self.rules[nt])):
+                    firsts[r][0].append(self._split(nt, r, 0, n))
+                self.counts[nt].append(sum(first[0][n] for first in firsts))
+            for nt, rules in self.rules.items():
+                for r, rule in enumerate(rules):
+                    for i in range(1, len(rule)):
+                        self.suffixes[nt][r][i].append(self._split(nt, r, i, n))
+            self.size = n
+
+    def count(self, size, symbol = None):
+        # the number of derivations of the given size
+        self.extend(size)
+        return self.counts[symbol or self.start_symbol][size]
+
+    def _pick(self, weights, total, rng):
+        # pick an index with probability weight / total
+        k = rng.randrange(total)
+        for i, w in weights:
+            if k < w: return i
+            k -= w
+        assert False
+
+    def _sizes(self, lo, hi):
+        # lo, hi, lo+1, hi-1, ... -- on average, a split is found after
+        # O(log n) steps this way.
+        while lo <= hi:
+            yield lo
+            if lo != hi: yield hi
+            lo, hi = lo + 1, hi - 1
+
+    def sample(self, size, rng = random, symbol = None):
+        """
+        A derivation tree drawn uniformly among those of the given size.
+        """
+        symbol = symbol or self.start_symbol
+        total = self.count(size, symbol)
+        if not total: raise ValueError('no derivation of %s of size %d' % (symbol, size))
+        tree = (symbol, [])
+        stack = [(tree[1], symbol, size)]
+        while stack:
+            (children, nt, n) = stack.pop()
+            rules = self.rules[nt]
+            weights = [suffixes[0][n] for suffixes in self.suffixes[nt]]
+            r = self._pick(enumerate(weights), self.counts[nt][n], rng)
+            rule = rules[r]
+            for i, (s, is_nt) in enumerate(rule):
+                if not is_nt:
+                    children.append((s, []))
+                    n -= len(s)
+                    continue
+                if i == len(rule) - 1:
+                    m = n
+                else:
+                    rest = self.suffixes[nt][r][i+1]
+                    counts = self.counts[s]
+                    total = self.suffixes[nt][r][i][n]
+                    m = self._pick(((m, counts[m] * rest[n - m]) for m in self._sizes(1, n - 1)),
+                                   total, rng)
+                child = (s, [])
+                children.append(child)
+                stack.append((child[1], s, m))
+                n -= m
+        return tree
+
+    def sample_string(self, size, rng = random, symbol = None):
+        # the string is built from the tree without recursion
+        strings, stack = [], [self.sample(size, rng, symbol)]
+        while stack:
+            (s, children) = stack.pop()
+            if children: stack.extend(reversed(children))
+            else: strings.append(s)
+        return ''.join(strings)
+
+if __name__ == "__main__":
+    import sys
+    import grammarfuzz
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sampler = SizeSampler(grammarfuzz.term_grammar)
+    print("Derivations of size %d: %d" % (size, sampler.count(size)))
+    for i in range(1, 20):
+        print(sampler.sample_string(size))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Steady-state evolution
+#
+# Instead of breeding a whole generation and sorting it, children are bred
+# a few at a time: parents are picked by tournament, and each child replaces
+# the worst individual if it is at least as fit. The worst individual is the
+# top of a heap, so each child costs O(log n) bookkeeping. Only the worst
+# individual is ever replaced, so the best ones survive (elitism), and each
+# child is bred a bounded number of times, so the loop cannot stall on a
+# plateau.
+
+import heapq
+import random
+import evolvefuzz
+from grammarfuzz import all_terminals, compile_grammar
+
+# How many individuals take part in a tournament
+TOURNAMENT_SIZE = 3
+
+# How often to retry breeding a child whose input is already in the
+# population
+MAX_RETRIES = 10
+
+class SteadyState:
+    def __init__(self, grammar, pop, mutator=None, pool=None,
+                 tournament_size=TOURNAMENT_SIZE, max_retries=MAX_RETRIES, rng=random):
+        self.grammar = compile_grammar(grammar)
+        self.mutator = mutator
+        self.pool = pool
+        self.tournament_size = tournament_size
+        self.max_retries = max_retries
+        self.rng = rng
+        # individuals are kept in slots; the heap has (-fitness, serial, slot)
+        # entries, with the worst individual on top.
+        self.trees = []
+        self.fitness = []
+        self.terms = []
+        self.known = set()
+        for (tree, fitness) in pop:
+            term = all_terminals(tree)
+            if term in self.known: continue
+            self.known.add(term)
+            self.trees.append(tree)
+            self.fitness.append(fitness)
+            self.terms.append(term)
+        self.heap = [(-f, i, i) for i, f in enumerate(self.fitness)]
+        self.serial = len(self.heap)
+        heapq.heapify(self.heap)
+        self.children = 0
+        self.replaced = 0
+        self.failed = 0
+
+    def __getstate__(self):
+        # the pool is not saved, and the random module is restored as such
+        state = dict(self.__dict__)
+        state['pool'] = None
+        state['rng'] = None if self.rng is random else self.rng
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None: self.rng = random
+
+    def select(self):
+        # the fittest of a few random individuals
+        slots = [self.rng.randrange(len(self.trees)) for i in range(self.tournament_size)]
+        return min(slots, key=lambda i: self.fitness[i])
+
+    def breed(self, pending):
+        # a child whose input is neither in the population nor pending, or
+        # None after max_retries tries
+        for i in range(self.max_retries):
+            parent = self.select()
+            if self.mutator is None:
+                (operator, child) = (None, evolvefuzz.mutate(self.trees[parent], self.grammar))
+            else:
+                (operator, child) = self.mutator.mutate(self.trees[parent], self.trees)
+            term = all_terminals(child)
+            if term not in self.known and term not in pending:
+                return (child, term, self.fitness[parent], operator)
+        return None
+
+    def insert(self, tree, term, fitness):
+        # replace the worst individual, if the new one is at least as fit
+        (worst, serial, slot) = self.heap[0]
+        if fitness > -worst: return False
+        self.known.discard(self.terms[slot])
+        self.known.add(term)
+        self.trees[slot] = tree
+        self.fitness[slot] = fitness
+        self.terms[slot] = term
+        heapq.heapreplace(self.heap, (-fitness, self.serial, slot))
+        self.serial += 1
+        self.replaced += 1
+        return True
+
+    def step(self, batch_size=1):
+        """
+        Breed up to batch_size children, evaluate them together, and insert
+        them. Returns the number of children inserted.
+        """
+        batch = {}
+        for i in range(batch_size):
+            bred = self.breed(batch)
+            if bred is None:
+                self.failed += 1
+                continue
+            batch[bred[1]] = bred
+        fitnesses = evolvefuzz.evaluate_terms(list(batch), self.pool)
+        inserted = 0
+        for ((child, term, parent_fitness, operator), fitness) in zip(batch.values(), fitnesses):
+            self.children += 1
+            if operator is not None:
+                self.mutator.reward(operator, fitness, parent_fitness)
+            if self.insert(child, term, fitness): inserted += 1
+        return inserted
+
+    def run(self, children, batch_size=1):
+        for i in range(0, children, batch_size):
+            self.step(min(batch_size, children - i))
+        return self.best()
+
+    def best(self):
+        i = min(range(len(self.trees)), key=lambda i: self.fitness[i])
+        return (self.trees[i], self.fitness[i])
+
+    def population(self):
+        return list(zip(self.trees, self.fitness))
+
+if __name__ == "__main__":
+    import mutators
+    grammar = compile_grammar(evolvefuzz.cgi_grammar)
+    engine = SteadyState(grammar, evolvefuzz.population(grammar),
+                         mutators.Mutator(grammar))
+    engine.run(evolvefuzz.EVOLUTION_CYCLES * evolvefuzz.POPULATION_SIZE)
+    evolvefuzz.print_population(engine.population())
+    print("%d children, %d inserted, %d failed to breed" %
+          (engine.children, engine.replaced, engine.failed))
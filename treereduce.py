@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Grammar-aware reduction of derivation trees
+#
+# Given a tree whose input has some property (covering an edge, raising an
+# exception, ...), find a smaller tree whose input still has it. For each
+# expanded node, largest first, we try to replace the subtree
+# - by the cheapest expansion of its nonterminal, and
+# - by a subtree of the same nonterminal below it (hoisting),
+# and keep the smallest replacement whose input still has the property,
+# until no replacement helps any more. The outcome for each input is cached
+# by the hash of the input, and the candidates for a node can be tested by
+# a process pool.
+
+import random
+import hashlib
+import evolvefuzz
+from grammarfuzz import expand_tree, all_terminals, compile_grammar
+from mutators import expanded_nodes, replace_node
+
+class Raises:
+    """
+    The property of raising an exception of the given type (and, if given,
+    with the given message) in the function of the target.
+    """
+    def __init__(self, exception, message=None):
+        self.exception = exception
+        self.message = message
+
+    def __call__(self, term):
+        try:
+            evolvefuzz.target.function(term)
+        except self.exception as e:
+            return self.message is None or str(e) == self.message
+        except Exception:
+            return False
+        return False
+
+class CoversEdge:
+    """
+    The property of covering the (from line, to line) edge of the target.
+    """
+    def __init__(self, edge):
+        self.edge = tuple(edge)
+
+    def __call__(self, term):
+        try:
+            coverage = evolvefuzz.target.execute(term)
+        except Exception:
+            return False
+        return any((i, j) == self.edge for f, i, j, src, l in coverage[0])
+
+class Reducer:
+    def __init__(self, grammar, predicate, pool=None):
+        self.grammar = compile_grammar(grammar)
+        self.predicate = predicate
+        self.pool = pool
+        # input digest -> outcome
+        self.outcomes = {}
+        # nonterminal -> a tree of its cheapest expansion
+        self.minimal = {}
+        self.tests = 0
+        self.hits = 0
+
+    def key(self, term):
+        return hashlib.blake2b(term.encode('utf-8'), digest_size=16).digest()
+
+    def test(self, terms):
+        # the outcome for each input; each input is tested at most once
+        keys = [self.key(term) for term in terms]
+        missing = {}
+        for k, term in zip(keys, terms):
+            if k in self.outcomes: self.hits += 1
+            elif k not in missing: missing[k] = term
+        if missing:
+            todo = list(missing.values())
+            if self.pool is None or len(todo) < 2:
+                outcomes = [self.predicate(term) for term in todo]
+            else:
+                outcomes = self.pool.map(self.predicate, todo)
+            self.tests += len(todo)
+            self.outcomes.update(zip(missing, outcomes))
+        return [self.outcomes[k] for k in keys]
+
+    def minimal_tree(self, symbol):
+        # the expansion with the fewest symbols, the same each time
+        if symbol not in self.minimal:
+            self.minimal[symbol] = expand_tree((symbol, None), self.grammar, 0,
+                                               random.Random(0))
+        return self.minimal[symbol]
+
+    def candidates(self, entries, k):
+        # the replacements for the node of entry k, with their inputs
+        node = entries[k][0]
+        symbol = node[0]
+        replacements = [self.minimal_tree(symbol)]
+        replacements.extend(n for (n, parent, index) in expanded_nodes(node)[1:]
+                            if n[0] == symbol)
+        return [(t, all_terminals(t)) for t in
+                (replace_node(entries, k, r) for r in replacements)]
+
+    def reduce(self, tree):
+        """
+        A tree whose input has the property and no larger replacement
+        reduces further. The input of tree must have the property.
+        """
+        term = all_terminals(tree)
+        if not self.test([term])[0]:
+            raise ValueError('the input does not have the property: %r' % term)
+        changed = True
+        while changed:
+            changed = False
+            entries = expanded_nodes(tree)
+            for k in range(len(entries)):
+                smaller = [(len(s), t, s) for (t, s) in self.candidates(entries, k)
+                           if len(s) < len(term)]
+                if not smaller: continue
+                smaller.sort(key=lambda c: c[0])
+                outcomes = self.test([s for (n, t, s) in smaller])
+                passing = [(t, s) for (n, t, s), ok in zip(smaller, outcomes) if ok]
+                if passing:
+                    (tree, term) = passing[0]
+                    changed = True
+                    # the node numbering changed; start over
+                    break
+        return tree
+
+# Reduce the tree, keeping the property predicate(term) of its input.
+# With processes, the candidates are tested by a pool loading the target of
+# evolvefuzz once per worker; the predicate must then pickle.
+def reduce_tree(tree, grammar, predicate, processes=0):
+    if not processes:
+        return Reducer(grammar, predicate).reduce(tree)
+    with evolvefuzz.fitness_pool(processes) as pool:
+        return Reducer(grammar, predicate, pool).reduce(tree)
+
+if __name__ == "__main__":
+    import sys
+    import earleyparse
+    grammar = evolvefuzz.cgi_grammar
+    term = sys.argv[1] if len(sys.argv) > 1 else 'a+b%41c+%ab%4?..!+%20:ca'
+    tree = earleyparse.EarleyParser(grammar).parse(term)
+    # the edge taken on invalid hex digits
+    reducer = Reducer(grammar, CoversEdge((40, 44)))
+    reduced = reducer.reduce(tree)
+    print("%r -> %r (%d tests, %d cached)" %
+          (term, all_terminals(reduced), reducer.tests, reducer.hits))